@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import re
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+import aiofiles
+import aiofiles.os
+
+from backend.app import changes, orthanc_client
+
+ARCHIVE_CACHE_ENABLED = os.getenv("ARCHIVE_CACHE_ENABLED", "1") == "1"
+# /tmp may be memory-backed; docker-compose.yml points this at a volume
+ARCHIVE_CACHE_DIR = os.getenv("ARCHIVE_CACHE_DIR", "/tmp/dicom-archives")
+ARCHIVE_CACHE_MAX_BYTES = int(os.getenv("ARCHIVE_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+# Build the ZIP as soon as Orthanc reports a study as stable, before anyone asks for it
+ARCHIVE_PREGENERATE = os.getenv("ARCHIVE_PREGENERATE", "0") == "1"
+ARCHIVE_PREGENERATE_CONCURRENCY = int(os.getenv("ARCHIVE_PREGENERATE_CONCURRENCY", "1"))
+
+# study id -> (last update, path, size), least recently used first
+entries: OrderedDict = OrderedDict()
+total_bytes = 0
+hits = 0
+misses = 0
+
+_filling: set = set()
+_pregenerate_semaphore: Optional[asyncio.Semaphore] = None
+_pregenerate_tasks: set = set()
+
+
+def _path(study_id: str, last_update: str) -> str:
+    return os.path.join(ARCHIVE_CACHE_DIR, f"{study_id}_{last_update}.zip")
+
+
+def _valid(study_id: str, last_update: Optional[str]) -> bool:
+    # Both end up in a file name
+    return bool(last_update and re.fullmatch(r"[0-9a-f-]+", study_id) and re.fullmatch(r"[0-9A-Za-z.]+", last_update))
+
+
+async def _remove(path: str):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def load():
+    # Rebuilds the index from the files left by a previous run, oldest access first
+    global total_bytes
+    await aiofiles.os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    found = []
+    for name in await aiofiles.os.listdir(ARCHIVE_CACHE_DIR):
+        path = os.path.join(ARCHIVE_CACHE_DIR, name)
+        match = re.fullmatch(r"([0-9a-f-]+)_([0-9A-Za-z.]+)\.zip", name)
+        if not match:
+            await _remove(path)
+            continue
+        stat = await aiofiles.os.stat(path)
+        found.append((stat.st_atime, match.group(1), match.group(2), path, stat.st_size))
+    for _, study_id, last_update, path, size in sorted(found):
+        if study_id in entries:
+            await forget(study_id)
+        entries[study_id] = (last_update, path, size)
+        total_bytes += size
+    await _evict()
+
+
+def lookup(study_id: str, last_update: Optional[str]) -> Optional[str]:
+    global hits, misses
+    entry = entries.get(study_id)
+    if entry is None or entry[0] != last_update:
+        misses += 1
+        return None
+    hits += 1
+    entries.move_to_end(study_id)
+    return entry[1]
+
+
+async def forget(study_id: str):
+    global total_bytes
+    entry = entries.pop(study_id, None)
+    if entry is not None:
+        total_bytes -= entry[2]
+        await _remove(entry[1])
+
+
+async def _evict():
+    while total_bytes > ARCHIVE_CACHE_MAX_BYTES and entries:
+        await forget(next(iter(entries)))
+
+
+async def _store(study_id: str, last_update: str, temp_path: str, size: int):
+    global total_bytes
+    if size > ARCHIVE_CACHE_MAX_BYTES:
+        await _remove(temp_path)
+        return
+    await forget(study_id)
+    path = _path(study_id, last_update)
+    await aiofiles.os.replace(temp_path, path)
+    entries[study_id] = (last_update, path, size)
+    total_bytes += size
+    await _evict()
+
+
+async def tee(study_id: str, last_update: Optional[str], chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Yields the archive unchanged while copying it to a temp file; the copy only enters
+    # the cache once the whole body went through, a broken download leaves nothing behind
+    key = (study_id, last_update)
+    if not ARCHIVE_CACHE_ENABLED or not _valid(study_id, last_update) or key in _filling:
+        async for chunk in chunks:
+            yield chunk
+        return
+    _filling.add(key)
+    temp_path = os.path.join(ARCHIVE_CACHE_DIR, f"{uuid.uuid4().hex}.tmp")
+    size = 0
+    try:
+        await aiofiles.os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+        async with aiofiles.open(temp_path, "wb") as temp_file:
+            async for chunk in chunks:
+                await temp_file.write(chunk)
+                size += len(chunk)
+                yield chunk
+        await _store(study_id, last_update, temp_path, size)
+    finally:
+        _filling.discard(key)
+        if await aiofiles.os.path.exists(temp_path):
+            await _remove(temp_path)
+
+
+async def pregenerate(study_id: str):
+    global _pregenerate_semaphore
+    if _pregenerate_semaphore is None:
+        _pregenerate_semaphore = asyncio.Semaphore(max(1, ARCHIVE_PREGENERATE_CONCURRENCY))
+    async with _pregenerate_semaphore:
+        client = orthanc_client.get_client()
+        response = await orthanc_client.request(client, "GET", f"/studies/{study_id}")
+        if response.status_code == 404:
+            return
+        response.raise_for_status()
+        last_update = response.json().get("LastUpdate")
+        if lookup(study_id, last_update):
+            return
+        async with orthanc_client.open_stream(client, "GET", f"/studies/{study_id}/archive") as archive:
+            archive.raise_for_status()
+            async for _ in tee(study_id, last_update, archive.aiter_bytes()):
+                pass
+        logging.info(f"Pre-generated archive for study {study_id}")
+
+
+async def _pregenerate_logged(study_id: str):
+    try:
+        await pregenerate(study_id)
+    except Exception as e:
+        logging.warning(f"Error pre-generating archive for study {study_id}: {e}")
+
+
+async def on_change(change: dict):
+    if change.get("ResourceType") != "Study" or change.get("ChangeType") not in ("StableStudy", "Deleted"):
+        return
+    # LastUpdate moved on, the cached ZIP can never be served again
+    await forget(change["ID"])
+    if ARCHIVE_CACHE_ENABLED and ARCHIVE_PREGENERATE and change["ChangeType"] == "StableStudy":
+        task = asyncio.create_task(_pregenerate_logged(change["ID"]))
+        _pregenerate_tasks.add(task)
+        task.add_done_callback(_pregenerate_tasks.discard)
+
+
+def stats() -> dict:
+    lookups = hits + misses
+    return {
+        "enabled": ARCHIVE_CACHE_ENABLED,
+        "pregenerate": ARCHIVE_PREGENERATE,
+        "size": len(entries),
+        "bytes": total_bytes,
+        "max_bytes": ARCHIVE_CACHE_MAX_BYTES,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / lookups if lookups else None,
+    }
+
+
+changes.subscribe(on_change)
@@ -0,0 +1,254 @@
+import asyncio
+import itertools
+import logging
+import os
+from typing import Optional
+
+from backend.app import orthanc_client
+from backend.app.cache import LRUCache
+
+ARCHIVE_JOB_POLL_INTERVAL = float(os.getenv("ARCHIVE_JOB_POLL_INTERVAL", "2"))
+ARCHIVE_JOB_DEADLINE = float(os.getenv("ARCHIVE_JOB_DEADLINE", "3600"))
+# While the Orthanc plugin pushes job events, polling only catches what a lost push missed
+ARCHIVE_JOB_FALLBACK_POLL_INTERVAL = float(os.getenv("ARCHIVE_JOB_FALLBACK_POLL_INTERVAL", "15"))
+ARCHIVE_JOB_PUSH_TIMEOUT = float(os.getenv("ARCHIVE_JOB_PUSH_TIMEOUT", "10"))
+JOB_EVENTS_TOKEN = os.getenv("JOB_EVENTS_TOKEN", "")
+
+# Same as ConcurrentJobs in orthanc.json: anything submitted beyond that only waits inside Orthanc, in FIFO order
+ARCHIVE_JOB_SLOTS = int(os.getenv("ARCHIVE_JOB_SLOTS", "2"))
+# Slots a single user may hold while others wait, so one bulk export cannot take all of them
+ARCHIVE_USER_SLOTS = int(os.getenv("ARCHIVE_USER_SLOTS", "1"))
+ARCHIVE_QUEUE_LIMIT = int(os.getenv("ARCHIVE_QUEUE_LIMIT", "200"))
+ARCHIVE_USER_QUEUE_LIMIT = int(os.getenv("ARCHIVE_USER_QUEUE_LIMIT", "20"))
+
+PRIORITIES = {"urgent": 0, "normal": 1, "bulk": 2}
+DEFAULT_PRIORITY = "normal"
+
+FINAL_STATES = {"Success", "Failure", "Timeout"}
+
+
+class ArchiveQueueFull(Exception):
+    pass
+
+
+class ArchiveJob:
+    def __init__(self, study_id: str, user: str, priority: int, seq: int):
+        self.study_id = study_id
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.job_id: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.status: Optional[dict] = None
+        self.subscribers: set[asyncio.Queue] = set()
+
+    def publish(self, status: dict):
+        self.status = status
+        for queue in self.subscribers:
+            # Subscribers only need the latest status, a slow socket skips intermediate progress
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+
+_seq = itertools.count()
+
+# Waiting for a slot, and holding one (being submitted or running in Orthanc)
+queued: list[ArchiveJob] = []
+running: set[ArchiveJob] = set()
+# Submitted jobs by Orthanc job id, polled by poll_jobs
+active_jobs: dict[str, ArchiveJob] = {}
+# Queued or running jobs by study, so that viewers of one study share a job
+jobs_by_study: dict[str, ArchiveJob] = {}
+
+_submissions: set = set()
+
+last_push: Optional[float] = None
+# Pushed statuses of jobs whose POST has not returned yet, a short job may finish before that
+early_events = LRUCache(1000)
+
+polls = 0
+pushes = 0
+shared_starts = 0
+rejected = 0
+
+
+def start(study_id: str, user: str, priority: str = DEFAULT_PRIORITY) -> ArchiveJob:
+    global shared_starts, rejected
+    rank = PRIORITIES.get(priority, PRIORITIES[DEFAULT_PRIORITY])
+    job = jobs_by_study.get(study_id)
+    if job is not None:
+        shared_starts += 1
+        # An urgent request for a study already queued as bulk moves it forward
+        if job.job_id is None and job not in running and rank < job.priority:
+            job.priority = rank
+            publish_positions()
+        return job
+    if len(queued) >= ARCHIVE_QUEUE_LIMIT:
+        rejected += 1
+        raise ArchiveQueueFull("Archive queue is full, try again later")
+    if sum(1 for queued_job in queued if queued_job.user == user) >= ARCHIVE_USER_QUEUE_LIMIT:
+        rejected += 1
+        raise ArchiveQueueFull(f"Too many queued archives, at most {ARCHIVE_USER_QUEUE_LIMIT} per user")
+    job = jobs_by_study[study_id] = ArchiveJob(study_id, user, rank, next(_seq))
+    queued.append(job)
+    schedule()
+    return job
+
+
+def schedule():
+    # Fills free slots in priority order, users that already hold their share go last.
+    # A slot nobody else is waiting for is still used, the cap never leaves Orthanc idle
+    queued.sort(key=lambda job: (job.priority, job.seq))
+    while len(running) < ARCHIVE_JOB_SLOTS and queued:
+        job = next((job for job in queued
+                    if sum(1 for held in running if held.user == job.user) < ARCHIVE_USER_SLOTS), queued[0])
+        queued.remove(job)
+        running.add(job)
+        task = asyncio.create_task(submit(job))
+        _submissions.add(task)
+        task.add_done_callback(_submissions.discard)
+    publish_positions()
+
+
+def publish_positions():
+    queued.sort(key=lambda job: (job.priority, job.seq))
+    for position, job in enumerate(queued, start=1):
+        status = {"State": "Queued", "Position": position}
+        if job.status != status:
+            job.publish(status)
+
+
+async def submit(job: ArchiveJob):
+    try:
+        job.job_id = await create_job(job.study_id)
+    except Exception as e:
+        logging.warning(f"Error starting archive job for study {job.study_id}: {e}")
+        finish(job, {"Progress": 0, "State": "Failure"})
+        return
+    job.started_at = asyncio.get_running_loop().time()
+    active_jobs[job.job_id] = job
+    early_status = early_events.pop(job.job_id)
+    if early_status is not None:
+        update(job, early_status)
+
+
+async def create_job(study_id: str) -> str:
+    response = await orthanc_client.request(
+        orthanc_client.get_client(), "POST",
+        f"/studies/{study_id}/archive",
+        json={"Asynchronous": True}
+    )
+    response.raise_for_status()
+    return response.json()["ID"]
+
+
+def subscribe(job: ArchiveJob) -> asyncio.Queue:
+    queue = asyncio.Queue(maxsize=1)
+    job.subscribers.add(queue)
+    if job.status is not None:
+        queue.put_nowait(job.status)
+    return queue
+
+
+def unsubscribe(job: ArchiveJob, queue: asyncio.Queue):
+    job.subscribers.discard(queue)
+    # Nobody waits for a job that has not reached Orthanc yet, it would only take a slot
+    if not job.subscribers and job in queued:
+        queued.remove(job)
+        jobs_by_study.pop(job.study_id, None)
+        publish_positions()
+
+
+def finish(job: ArchiveJob, status: dict):
+    job.publish(status)
+    running.discard(job)
+    if job.job_id is not None:
+        active_jobs.pop(job.job_id, None)
+    if jobs_by_study.get(job.study_id) is job:
+        del jobs_by_study[job.study_id]
+    schedule()
+
+
+async def fetch_job(client, job_id: str) -> Optional[dict]:
+    response = await orthanc_client.request(client, "GET", f"/jobs/{job_id}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+async def poll_once(client):
+    global polls
+    polls += 1
+    # One request covers every job Orthanc still knows about, whatever the number of viewers
+    response = await orthanc_client.request(client, "GET", "/jobs", params={"expand": ""})
+    response.raise_for_status()
+    statuses = {job_status["ID"]: job_status for job_status in response.json()}
+    missing = [job_id for job_id in active_jobs if job_id not in statuses]
+    for job_id, job_status in zip(missing, await orthanc_client.gather_bounded(
+            lambda job_id: fetch_job(client, job_id), missing)):
+        statuses[job_id] = job_status or {"Progress": 0, "State": "Failure"}
+
+    for job in list(active_jobs.values()):
+        if job.job_id in statuses:
+            update(job, statuses[job.job_id])
+
+
+def update(job: ArchiveJob, job_status: dict):
+    status = {"Progress": job_status.get("Progress", 0), "State": job_status.get("State", "Unknown")}
+    if status["State"] not in FINAL_STATES and asyncio.get_running_loop().time() - job.started_at > ARCHIVE_JOB_DEADLINE:
+        status = {"Progress": 0, "State": "Timeout"}
+    if status["State"] in FINAL_STATES:
+        finish(job, status)
+    elif status != job.status:
+        job.publish(status)
+
+
+def apply_events(job_statuses: list[dict]):
+    # Job progress pushed by the Orthanc plugin, forwarded to subscribers as soon as it arrives
+    global last_push, pushes
+    last_push = asyncio.get_running_loop().time()
+    pushes += 1
+    for job_status in job_statuses:
+        job = active_jobs.get(job_status["ID"])
+        if job is not None:
+            update(job, job_status)
+        elif running:
+            early_events.set(job_status["ID"], job_status)
+
+
+def poll_interval() -> float:
+    if last_push is not None and asyncio.get_running_loop().time() - last_push < ARCHIVE_JOB_PUSH_TIMEOUT:
+        return ARCHIVE_JOB_FALLBACK_POLL_INTERVAL
+    return ARCHIVE_JOB_POLL_INTERVAL
+
+
+async def poll_jobs():
+    client = orthanc_client.get_client()
+    polled_at = 0.0
+    while True:
+        try:
+            now = asyncio.get_running_loop().time()
+            if active_jobs and now - polled_at >= poll_interval():
+                polled_at = now
+                await poll_once(client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Error polling Orthanc jobs: {e}")
+        await asyncio.sleep(ARCHIVE_JOB_POLL_INTERVAL)
+
+
+def stats() -> dict:
+    return {
+        "queued": len(queued),
+        "running": len(running),
+        "slots": ARCHIVE_JOB_SLOTS,
+        "active_jobs": len(active_jobs),
+        "subscribers": sum(len(job.subscribers) for job in itertools.chain(queued, running)),
+        "polls": polls,
+        "pushes": pushes,
+        "shared_starts": shared_starts,
+        "rejected": rejected,
+    }
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from backend.app import orthanc_client
+
+MAX_FINISHED_JOBS = 100
+
+
+class BackgroundJob:
+    def __init__(self, kind: str, items: list):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.items = items
+        self.state = "Pending"
+        self.completed = 0
+        self.failed = 0
+        self.errors: dict[str, str] = {}
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "total": len(self.items),
+            "completed": self.completed,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+
+jobs: OrderedDict = OrderedDict()
+_tasks: set = set()
+
+
+def get_job(job_id: str) -> Optional[BackgroundJob]:
+    return jobs.get(job_id)
+
+
+def start_job(kind: str, items: Iterable[Any], func: Callable[[Any], Awaitable[Any]], limit: int) -> BackgroundJob:
+    # Runs func over every item in the background, at most `limit` at a time, counting progress per item
+    job = BackgroundJob(kind, list(items))
+    jobs[job.id] = job
+    _forget_finished_jobs()
+
+    async def run_item(item):
+        try:
+            await func(item)
+            job.completed += 1
+        except Exception as e:
+            job.failed += 1
+            job.errors[str(item)] = str(getattr(e, "detail", e))
+
+    async def run():
+        job.state = "Running"
+        try:
+            await orthanc_client.gather_bounded(run_item, job.items, limit)
+            job.state = "Success" if not job.failed else "Failure"
+        except Exception as e:
+            logging.error(f"Background job {job.id} ({kind}) failed: {e}")
+            job.state = "Failure"
+        finally:
+            job.finished_at = time.time()
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
+
+
+def _forget_finished_jobs():
+    finished = [job_id for job_id, job in jobs.items() if job.finished_at is not None]
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del jobs[job_id]
@@ -0,0 +1,178 @@
+import asyncio
+import io
+import logging
+import os
+import re
+import zipfile
+from collections import deque
+from typing import AsyncIterator, Optional, Tuple
+
+from backend.app import orthanc_client
+
+# Instances downloaded ahead of the one being written, and the bytes they may buffer in total
+BUNDLE_PREFETCH = int(os.getenv("BUNDLE_PREFETCH", "8"))
+BUNDLE_PREFETCH_BYTES = int(os.getenv("BUNDLE_PREFETCH_BYTES", str(64 * 1024 * 1024)))
+BUNDLE_CHUNK_SIZE = int(os.getenv("BUNDLE_CHUNK_SIZE", str(1024 * 1024)))
+
+# The folder every path starts with: patient/study/series/, study/series/ or series/
+LAYOUTS = ("patient", "study", "series")
+
+Entry = Tuple[str, str]
+
+
+class ZipSink(io.RawIOBase):
+    # Unseekable target for zipfile: what was written is taken out with drain() and sent right away
+    def __init__(self):
+        super().__init__()
+        self.chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def safe_name(*parts: Optional[str]) -> str:
+    name = "_".join(part for part in parts if part)
+    return re.sub(r"[^\w.-]+", "_", name).strip("._") or "unknown"
+
+
+async def study_entries(client, study_id: str, layout: str) -> list[Entry]:
+    # (path in the archive, instance id) for every instance of the study
+    study_details = await orthanc_client.get_json(client, f"/studies/{study_id}")
+    series_list = await orthanc_client.get_json(client, f"/studies/{study_id}/series?expand")
+    patient_tags = study_details.get("PatientMainDicomTags", {})
+    study_tags = study_details.get("MainDicomTags", {})
+    folders = []
+    if layout == "patient":
+        folders.append(safe_name(patient_tags.get("PatientName"), patient_tags.get("PatientID")))
+    if layout in ("patient", "study"):
+        folders.append(safe_name(study_tags.get("StudyDate"), study_tags.get("StudyDescription"), study_id[:8]))
+    entries = []
+    for series_info in series_list:
+        series_tags = series_info.get("MainDicomTags", {})
+        series_folder = safe_name(series_tags.get("SeriesNumber"), series_tags.get("Modality"),
+                                  series_tags.get("SeriesDescription"), series_info["ID"][:8])
+        for instance_id in series_info.get("Instances", []):
+            entries.append(("/".join(folders + [series_folder, f"{instance_id}.dcm"]), instance_id))
+    return entries
+
+
+async def iter_entries(client, study_ids: list[str], layout: str, errors: list[str]) -> AsyncIterator[Entry]:
+    for study_id in study_ids:
+        try:
+            entries = await study_entries(client, study_id, layout)
+        except Exception as e:
+            errors.append(f"study {study_id}: {e}")
+            continue
+        for entry in entries:
+            yield entry
+
+
+class ByteBudget:
+    # Bytes buffered by instances read ahead. The instance being written (the head) never waits,
+    # otherwise instances further ahead could take the whole budget and stall the archive
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.head = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, index: int, size: int):
+        async with self._changed:
+            await self._changed.wait_for(lambda: index <= self.head or self.used + size <= self.limit)
+            self.used += size
+
+    async def release(self, size: int):
+        async with self._changed:
+            self.used -= size
+            self._changed.notify_all()
+
+    async def advance(self, index: int):
+        async with self._changed:
+            self.head = index
+            self._changed.notify_all()
+
+
+async def fetch_instance(client, instance_id: str, index: int, chunks: asyncio.Queue, budget: ByteBudget):
+    # Puts the instance file chunk by chunk into `chunks`, then None, or the exception that stopped it
+    try:
+        async with orthanc_client.open_stream(client, "GET", f"/instances/{instance_id}/file") as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(BUNDLE_CHUNK_SIZE):
+                await budget.acquire(index, len(chunk))
+                chunks.put_nowait(chunk)
+        chunks.put_nowait(None)
+    except Exception as e:
+        chunks.put_nowait(e)
+
+
+async def prefetch(client, entries: AsyncIterator[Entry], window: int, budget: ByteBudget):
+    # Keeps up to `window` instance downloads running; they are handed out in order with their task,
+    # which the consumer cancels once done with the member
+    pending = deque()
+    index = 0
+    try:
+        async for entry in entries:
+            chunks = asyncio.Queue()
+            pending.append((entry, chunks, asyncio.create_task(fetch_instance(client, entry[1], index, chunks, budget))))
+            index += 1
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+        await entries.aclose()
+
+
+async def stream_bundle(study_ids: list[str], layout: str = "patient", window: int = BUNDLE_PREFETCH,
+                        prefetch_bytes: int = BUNDLE_PREFETCH_BYTES) -> AsyncIterator[bytes]:
+    # ZIP_STORED: DICOM pixel data is mostly compressed already, deflating it again costs CPU for little gain.
+    # Sizes are unknown up front, so every member gets a data descriptor and ZIP64 fields
+    client = orthanc_client.get_client()
+    errors: list[str] = []
+    budget = ByteBudget(prefetch_bytes)
+    sink = ZipSink()
+    position = 0
+    # Closed explicitly (contextlib.aclosing is 3.10+), so downloads stop as soon as the client goes away
+    instances = prefetch(client, iter_entries(client, study_ids, layout, errors), max(1, window), budget)
+    try:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
+            async for (name, instance_id), chunks, task in instances:
+                try:
+                    await budget.advance(position)
+                    position += 1
+                    chunk = await chunks.get()
+                    if isinstance(chunk, Exception):
+                        errors.append(f"instance {instance_id}: {chunk}")
+                        continue
+                    with archive.open(name, "w", force_zip64=True) as member:
+                        while chunk is not None:
+                            if isinstance(chunk, Exception):
+                                # Part of the member is already sent, it stays in the archive truncated
+                                errors.append(f"instance {instance_id}: truncated, {chunk}")
+                                break
+                            member.write(chunk)
+                            await budget.release(len(chunk))
+                            yield sink.drain()
+                            chunk = await chunks.get()
+                    yield sink.drain()
+                finally:
+                    # The head download is exempt from the budget, it must not outlive its reader
+                    task.cancel()
+            if errors:
+                # Headers are long gone by now, failures are reported inside the archive
+                logging.warning(f"Bundle download finished with {len(errors)} errors")
+                archive.writestr("ERRORS.txt", "\n".join(errors) + "\n")
+        yield sink.drain()
+    finally:
+        await instances.aclose()
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from backend.app import orthanc_client
+
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+CHANGES_BATCH_SIZE = int(os.getenv("CHANGES_BATCH_SIZE", "100"))
+
+_subscribers: list[Callable[[dict], Awaitable[None]]] = []
+
+last_seq: Optional[int] = None
+
+
+def subscribe(callback: Callable[[dict], Awaitable[None]]):
+    _subscribers.append(callback)
+
+
+async def fetch_changes(client, since: Optional[int] = None, limit: int = CHANGES_BATCH_SIZE) -> dict:
+    if since is None:
+        response = await orthanc_client.request(client, "GET", "/changes", params={"last": ""})
+    else:
+        response = await orthanc_client.request(client, "GET", "/changes", params={"since": since, "limit": limit})
+    response.raise_for_status()
+    return response.json()
+
+
+async def dispatch(change: dict):
+    for callback in _subscribers:
+        try:
+            await callback(change)
+        except Exception as e:
+            logging.error(f"Change handler {callback.__name__} failed on {change.get('Seq')}: {e}")
+
+
+async def watch_changes(since: Optional[int] = None):
+    # Tails Orthanc's /changes feed, starting from the current end unless `since` is given
+    global last_seq
+    client = orthanc_client.get_client()
+    while True:
+        try:
+            if since is None:
+                since = (await fetch_changes(client))["Last"]
+            changes = await fetch_changes(client, since)
+            for change in changes.get("Changes", []):
+                await dispatch(change)
+            since = last_seq = changes["Last"]
+            if changes.get("Done", True):
+                await asyncio.sleep(CHANGES_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Error reading Orthanc changes: {e}")
+            await asyncio.sleep(CHANGES_POLL_INTERVAL)
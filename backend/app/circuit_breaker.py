@@ -0,0 +1,60 @@
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # closed: calls pass; open: calls fail fast until reset_timeout passes;
+    # half_open: one trial call decides whether to close again or re-open
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        if self.state == "closed":
+            return
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError("Orthanc circuit breaker is open")
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def abandon_call(self):
+        # A cancelled call says nothing about Orthanc's health, just free the half-open trial
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": "open" if self.is_open else ("half_open" if self.state != "closed" else "closed"),
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected_calls": self.rejected,
+        }
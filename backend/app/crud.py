@@ -1,12 +1,12 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from . import models, schemas
+from sqlalchemy import delete, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from typing import Optional
+from . import models, schemas, orthanc_client
 from passlib.context import CryptContext
-from pyorthanc import Orthanc
 import logging
 
-Orthanc = Orthanc('http://localhost:8042')
-
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 async def get_user_by_email(db: AsyncSession, email: str):
@@ -62,7 +62,7 @@ async def update_news(db: AsyncSession, news_id: int, news_data: schemas.NewsAdd
 async def send_dicom_file_to_orthanc(dicom_file: bytes):
     try:
         # Отправляем DICOM файл на Orthanc
-        response = await Orthanc.post_instances(dicom_file)  # Используем метод post_instances
+        response = await orthanc_client.get_client().post_instances(dicom_file)  # Используем метод post_instances
         if response.get('success', False):  # Проверяем наличие ключа 'success' в ответе
             return {"message": "DICOM file successfully uploaded to Orthanc"}
         else:
@@ -70,4 +70,67 @@ async def send_dicom_file_to_orthanc(dicom_file: bytes):
             raise Exception(f"Ошибка при отправке: {response.get('error', 'Unknown error')}")
     except Exception as e:
         logging.error(f"Ошибка при отправке DICOM файла: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+STUDY_INDEX_SORT_COLUMNS = {
+    "LastUpdate": models.StudyIndex.last_update,
+    "PatientName": models.StudyIndex.patient_name,
+    "StudyDate": models.StudyIndex.study_date,
+}
+
+async def upsert_indexed_studies(db: AsyncSession, rows: list[dict]):
+    if not rows:
+        return
+    statement = insert(models.StudyIndex).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.StudyIndex.id],
+        set_={column: statement.excluded[column] for column in rows[0] if column != "id"}
+    )
+    await db.execute(statement)
+
+async def delete_indexed_studies(db: AsyncSession, study_ids: list[str]):
+    if study_ids:
+        await db.execute(delete(models.StudyIndex).where(models.StudyIndex.id.in_(study_ids)))
+
+async def list_indexed_studies(db: AsyncSession, query: dict, limit: Optional[int] = None, since: Optional[int] = None,
+                               sort: Optional[str] = None):
+    # `query` uses the same Orthanc tag names and syntax as a /tools/find query
+    statement = select(models.StudyIndex)
+    if query.get("PatientName"):
+        # Literal % and _ in the value must not act as wildcards, only Orthanc's * and ? do
+        pattern = query["PatientName"].lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = pattern.replace("*", "%").replace("?", "_")
+        statement = statement.where(func.lower(models.StudyIndex.patient_name).like(pattern, escape="\\"))
+    if query.get("StudyDate"):
+        date_from, _, date_to = query["StudyDate"].partition("-")
+        if date_from:
+            statement = statement.where(models.StudyIndex.study_date >= date_from)
+        if date_to:
+            statement = statement.where(models.StudyIndex.study_date <= date_to)
+    if query.get("ModalitiesInStudy"):
+        # Stored as Orthanc returns it, "CT\\PT"; matched on whole values, so PT does not match OPT
+        modalities = query["ModalitiesInStudy"].split("\\")
+        delimited = "\\" + models.StudyIndex.modalities + "\\"
+        statement = statement.where(or_(*(delimited.contains(f"\\{m}\\", autoescape=True) for m in modalities)))
+    if query.get("StudyInstanceUID"):
+        statement = statement.where(models.StudyIndex.study_instance_uid == query["StudyInstanceUID"])
+    if query.get("MedicalCardNumber"):
+        statement = statement.where(models.StudyIndex.medical_card_number == query["MedicalCardNumber"])
+
+    if sort:
+        column = STUDY_INDEX_SORT_COLUMNS[sort.lstrip("-")]
+        statement = statement.order_by(column.desc() if sort.startswith("-") else column.asc())
+    statement = statement.order_by(models.StudyIndex.id)
+    if since:
+        statement = statement.offset(since)
+    if limit:
+        statement = statement.limit(limit)
+    result = await db.execute(statement)
+    return result.scalars().all()
+
+async def get_sync_state(db: AsyncSession, name: str) -> Optional[int]:
+    state = await db.get(models.SyncState, name)
+    return state.last_change if state else None
+
+async def set_sync_state(db: AsyncSession, name: str, last_change: int):
+    await db.merge(models.SyncState(name=name, last_change=last_change))
@@ -0,0 +1,133 @@
+import hashlib
+import io
+import os
+from typing import AsyncIterator, BinaryIO, Optional, Tuple
+
+import httpx
+import pydicom
+
+from backend.app import changes, orthanc_client
+from backend.app.cache import LRUCache
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_INDEX_SIZE = int(os.getenv("DEDUP_INDEX_SIZE", "1000000"))
+# Enough to hold the meta header and the dataset elements that precede SOPInstanceUID
+DEDUP_HEADER_BYTES = int(os.getenv("DEDUP_HEADER_BYTES", str(64 * 1024)))
+
+# The tags Orthanc hashes into an instance ID, in that order
+IDENTIFYING_TAGS = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+
+# Orthanc instance ID -> content sha256 (if known), and content sha256 -> Orthanc instance ID
+known_instances = LRUCache(DEDUP_INDEX_SIZE)
+known_hashes = LRUCache(DEDUP_INDEX_SIZE)
+
+duplicates_skipped = 0
+bytes_saved = 0
+
+
+def orthanc_instance_id(header: bytes) -> Optional[str]:
+    # The ID Orthanc will give the instance: SHA-1 of PatientID|StudyInstanceUID|SeriesInstanceUID|SOPInstanceUID.
+    # A re-sent file with a corrected PatientID is a different instance and must reach Orthanc
+    if not header:
+        return None
+    try:
+        dataset = pydicom.dcmread(io.BytesIO(header), stop_before_pixels=True, specific_tags=IDENTIFYING_TAGS)
+        values = [str(dataset.get(tag) or "").strip() for tag in IDENTIFYING_TAGS]
+    except Exception:
+        # Header too large for DEDUP_HEADER_BYTES or not DICOM at all, Orthanc will decide
+        return None
+    if not all(values[1:]):
+        return None
+    digest = hashlib.sha1("|".join(values).encode()).hexdigest()
+    return "-".join(digest[i:i + 8] for i in range(0, 40, 8))
+
+
+def hash_file(fileobj: BinaryIO) -> str:
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    while chunk := fileobj.read(orthanc_client.UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+async def split_header(stream: AsyncIterator[bytes]) -> Tuple[bytes, AsyncIterator[bytes]]:
+    # Buffers just the first DEDUP_HEADER_BYTES of a stream and hands back the rest untouched
+    header = b""
+    async for chunk in stream:
+        header += chunk
+        if len(header) >= DEDUP_HEADER_BYTES:
+            break
+    return header, stream
+
+
+async def find_duplicate(orthanc_id: Optional[str], digest: Optional[str]) -> Optional[str]:
+    duplicate_id = None
+    if orthanc_id and orthanc_id in known_instances:
+        duplicate_id = orthanc_id
+    elif digest and digest in known_hashes:
+        duplicate_id = known_hashes.get(digest)
+    if duplicate_id is None:
+        return None
+    # The index may lag behind a delete, Orthanc has the last word before anything is skipped
+    response = await orthanc_client.request(orthanc_client.get_client(), "GET", f"/instances/{duplicate_id}")
+    if response.status_code == 404:
+        forget(duplicate_id)
+    return duplicate_id if response.is_success else None
+
+
+def record_skip(size: int):
+    global duplicates_skipped, bytes_saved
+    duplicates_skipped += 1
+    bytes_saved += size
+
+
+def remember(orthanc_id: Optional[str], digest: Optional[str] = None):
+    if not orthanc_id:
+        return
+    if digest:
+        known_hashes.set(digest, orthanc_id)
+    known_instances.set(orthanc_id, digest or known_instances.peek(orthanc_id))
+
+
+def forget(orthanc_id: str):
+    digest = known_instances.pop(orthanc_id)
+    if digest:
+        known_hashes.pop(digest)
+
+
+async def study_instances(client, study_id: str) -> list[str]:
+    # Listed before a study is deleted, its Deleted change does not name the instances
+    if not DEDUP_ENABLED or not len(known_instances):
+        return []
+    try:
+        study_details = await orthanc_client.get_json(client, f"/studies/{study_id}")
+        series_list = await orthanc_client.gather_bounded(
+            lambda series_id: orthanc_client.get_json(client, f"/series/{series_id}"), study_details.get("Series", []))
+    except httpx.HTTPError:
+        # Entries left behind are caught by find_duplicate
+        return []
+    return [instance_id for series_info in series_list for instance_id in series_info.get("Instances", [])]
+
+
+async def on_change(change: dict):
+    if not DEDUP_ENABLED:
+        return
+    change_type, level, resource_id = change.get("ChangeType"), change.get("ResourceType"), change.get("ID")
+    if change_type == "NewInstance":
+        # The change carries the Orthanc ID, which is all the index needs
+        remember(resource_id)
+    elif change_type == "Deleted" and level == "Instance":
+        forget(resource_id)
+
+
+def stats() -> dict:
+    return {
+        "enabled": DEDUP_ENABLED,
+        "known_instances": len(known_instances),
+        "duplicates_skipped": duplicates_skipped,
+        "bytes_saved": bytes_saved,
+    }
+
+
+changes.subscribe(on_change)
@@ -0,0 +1,34 @@
+import hashlib
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Instances never change once stored ("OverwriteInstances": false). Their tags hold patient data,
+# only the browser may keep them, never a shared proxy
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Studies and series change as instances arrive, clients must revalidate with the ETag
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    # Weak, because the same tags may be served gzip-encoded or not
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+
+def cache_headers(etag: str, cache_control: str) -> dict:
+    return {"ETag": etag, "Cache-Control": cache_control}
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, cache_control))
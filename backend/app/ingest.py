@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import posixpath
+import zipfile
+from contextlib import nullcontext
+from functools import partial
+from typing import AsyncIterator, BinaryIO, Callable, ContextManager, Iterable, Iterator, Optional, Tuple
+
+import httpx
+
+from backend.app import dedup, orthanc_client
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "8"))
+
+# (name, opener returning a binary file object, uncompressed size if known)
+Source = Tuple[str, Callable[[], ContextManager[BinaryIO]], Optional[int]]
+
+
+def iter_sources(fileobj: BinaryIO, filename: str, size: Optional[int] = None) -> Iterator[Source]:
+    # A ZIP yields one source per member, read lazily from the archive; anything else is a single instance.
+    # Reading the central directory is blocking file I/O, ingest() advances this on a worker thread
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        archive = zipfile.ZipFile(fileobj)
+        for info in archive.infolist():
+            if info.is_dir() or posixpath.basename(info.filename).upper() == "DICOMDIR":
+                continue
+            yield f"{filename}/{info.filename}", partial(archive.open, info), info.file_size
+    else:
+        fileobj.seek(0)
+        yield filename, partial(nullcontext, fileobj), size
+
+
+async def read_chunks(fileobj: BinaryIO):
+    # Member reads decompress on a worker thread so the event loop keeps serving other requests
+    while chunk := await asyncio.to_thread(fileobj.read, orthanc_client.UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+def instance_result(name: str, response: dict) -> dict:
+    status = "duplicate" if response.get("Status") == "AlreadyStored" else "stored"
+    return {"name": name, "status": status, "id": response.get("ID")}
+
+
+async def store_body(name: str, header: bytes, rest: AsyncIterator[bytes], size: Optional[int],
+                     digest: Optional[str] = None) -> dict:
+    # `header` holds the first bytes already read from the instance, `rest` yields the remainder
+    orthanc_id = dedup.orthanc_instance_id(header) if dedup.DEDUP_ENABLED else None
+    duplicate_id = await dedup.find_duplicate(orthanc_id, digest) if dedup.DEDUP_ENABLED else None
+    if duplicate_id:
+        bytes_saved = size or len(header)
+        dedup.record_skip(bytes_saved)
+        return {"name": name, "status": "duplicate", "id": duplicate_id, "skipped": True, "bytes_saved": bytes_saved}
+
+    hasher = hashlib.sha256() if digest is None else None
+
+    async def body():
+        if header:
+            if hasher:
+                hasher.update(header)
+            yield header
+        async for chunk in rest:
+            if hasher:
+                hasher.update(chunk)
+            yield chunk
+
+    response = await orthanc_client.post_instance(body(), size)
+    if response.get("Status") in ("Success", "AlreadyStored"):
+        dedup.remember(response.get("ID"), digest or hasher.hexdigest())
+    return instance_result(name, response)
+
+
+async def store_instance(name: str, opener: Callable[[], ContextManager[BinaryIO]], size: Optional[int]) -> dict:
+    try:
+        # Opening a member reads its local header from the archive file
+        with await asyncio.to_thread(opener) as fileobj:
+            header, digest = b"", None
+            if dedup.DEDUP_ENABLED:
+                header = await asyncio.to_thread(fileobj.read, dedup.DEDUP_HEADER_BYTES)
+                if dedup.orthanc_instance_id(header) is None and fileobj.seekable():
+                    # No identifying tags to go by, fall back to the content hash, read from the start again
+                    digest = await asyncio.to_thread(dedup.hash_file, fileobj)
+                    header = b""
+            return await store_body(name, header, read_chunks(fileobj), size, digest)
+    except httpx.HTTPStatusError as exc:
+        return {"name": name, "status": "failed", "error": exc.response.text}
+    except Exception as exc:
+        return {"name": name, "status": "failed", "error": str(getattr(exc, "detail", exc))}
+
+
+async def store_stream(name: str, stream: AsyncIterator[bytes], size: Optional[int]) -> dict:
+    header = b""
+    if dedup.DEDUP_ENABLED:
+        header, stream = await dedup.split_header(stream)
+    return await store_body(name, header, stream, size)
+
+
+async def ingest(sources: Iterable[Source], concurrency: int = INGEST_CONCURRENCY) -> dict:
+    # A fixed pool of workers pulls from a short queue, so only `concurrency` instances are open at a time
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    results: list = []
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            index, source = item
+            results.append((index, await store_instance(*source)))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    items = enumerate(sources)
+    try:
+        while (item := await asyncio.to_thread(next, items, None)) is not None:
+            await queue.put(item)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    instances = [result for _, result in sorted(results, key=lambda item: item[0])]
+    summary = {"total": len(instances), "stored": 0, "duplicate": 0, "failed": 0,
+               "duplicates_skipped": 0, "bytes_saved": 0}
+    for result in instances:
+        summary[result["status"]] += 1
+        if result.get("skipped"):
+            summary["duplicates_skipped"] += 1
+            summary["bytes_saved"] += result["bytes_saved"]
+    summary["instances"] = instances
+    return summary
+
+
+def sources_from_uploads(files) -> Iterator[Source]:
+    return itertools.chain.from_iterable(iter_sources(file.file, file.filename, file.size) for file in files)
@@ -1,29 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, WebSocket, WebSocketDisconnect, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, WebSocket, WebSocketDisconnect, APIRouter, Query, Response, Request, Header
 from httpx import stream
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 import logging
+import os
 from pydantic import BaseModel
-from backend.app import crud, schemas, auth
+from backend.app import crud, schemas, auth, orthanc_client, changes, metadata_cache, http_cache, study_index, background_jobs, ingest, uploads, dedup, archive_cache, archive_jobs, bundle
 from backend.app.database import AsyncSessionLocal
 from typing import Optional
 import traceback
 import base64
-from pyorthanc import Orthanc
-import aiofiles
 import httpx
 import asyncio
 from starlette.responses import StreamingResponse
 import random
+import secrets
 import smtplib
+import json
+import zipfile
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+from functools import partial
 from email.mime.text import MIMEText
 
-OrthancAPI = Orthanc('http://orthanc:8042')
-
-orthanc_url = "http://orthanc:8042"
-
 router = APIRouter()
 
 class LoginData(BaseModel):
@@ -34,7 +35,25 @@ class VerificationData(BaseModel):
     email: str
     code: str
 
-app = FastAPI(root_path="/api")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await orthanc_client.open_client()
+    if archive_cache.ARCHIVE_CACHE_ENABLED:
+        await archive_cache.load()
+    tasks = [asyncio.create_task(changes.watch_changes())]
+    tasks.append(asyncio.create_task(uploads.collect_abandoned_sessions()))
+    tasks.append(asyncio.create_task(archive_jobs.poll_jobs()))
+    if study_index.STUDY_INDEX_ENABLED:
+        tasks.append(asyncio.create_task(study_index.sync_changes()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await orthanc_client.close_client()
+
+app = FastAPI(root_path="/api", lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -52,6 +71,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Location", "Upload-Offset", "Upload-Length", "Content-Range", "Accept-Ranges"],
 )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -196,87 +216,310 @@ async def update_news(
 
 @app.post("/upload-dicom/")
 async def upload_dicom(file: UploadFile = File(...)):
+    # Загрузите файл в Orthanc по частям, пропуская уже сохранённые экземпляры
+    result = await ingest.store_instance(file.filename, partial(nullcontext, file.file), file.size)
+    if result["status"] == "failed":
+        raise HTTPException(status_code=400, detail=f"Error uploading DICOM file: {result['error']}")
+    return {"message": "DICOM file uploaded successfully", "response": result}
+
+@app.post("/upload-dicom/stream")
+async def upload_dicom_stream(request: Request):
+    # Raw application/dicom body, relayed to Orthanc without multipart parsing or spooling to disk
     try:
-        # Сохраните файл временно
-        temp_file_path = f"/tmp/{file.filename}"
-        async with aiofiles.open(temp_file_path, 'wb') as out_file:
-            content = await file.read()
-            await out_file.write(content)
-
-        # Загрузите файл в Orthanc
-        with open(temp_file_path, 'rb') as dicom_file:
-            dicom_data = dicom_file.read()
-            response = OrthancAPI.post_instances(dicom_data)
-
-        return {"message": "DICOM file uploaded successfully", "response": response}
+        content_length = request.headers.get("content-length")
+        result = await ingest.store_stream(
+            "stream",
+            request.stream(),
+            int(content_length) if content_length else None
+        )
+        return {"message": "DICOM file uploaded successfully", "response": result}
+    except orthanc_client.OrthancUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error uploading DICOM file: {str(e)}")
 
-@app.get("/studies/", response_model=list[schemas.Study])
-async def get_studies():
+@app.post("/upload-dicom/batch")
+async def upload_dicom_batch(files: list[UploadFile] = File(...)):
+    # Several DICOM files and/or ZIP archives, stored in parallel with a per-instance report
+    try:
+        return await ingest.ingest(ingest.sources_from_uploads(files))
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid ZIP archive: {str(e)}")
+
+# Resumable uploads: create a session, PUT chunks at the current Upload-Offset
+# (HEAD tells where to resume after a failure), then finalize to store the data in Orthanc
+def upload_session_headers(request: Request, session: dict) -> dict:
+    return {
+        # root_path ("/api") is where the frontend and tus clients reach this app
+        "Location": f"{request.scope.get('root_path', '')}/uploads/{session['upload_id']}",
+        "Upload-Offset": str(session["offset"]),
+        "Upload-Length": str(session["length"]),
+    }
+
+@app.post("/uploads/", response_model=schemas.UploadSession, status_code=status.HTTP_201_CREATED)
+async def create_upload_session(session_data: schemas.UploadSessionCreate, request: Request, response: Response):
+    session = await uploads.create_session(session_data.filename, session_data.length)
+    response.headers.update(upload_session_headers(request, session))
+    return session
+
+@app.head("/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str, request: Request):
+    session = await uploads.get_session(upload_id)
+    return Response(headers=upload_session_headers(request, session))
+
+@app.get("/uploads/{upload_id}", response_model=schemas.UploadSession)
+async def get_upload_session(upload_id: str, request: Request, response: Response):
+    session = await uploads.get_session(upload_id)
+    response.headers.update(upload_session_headers(request, session))
+    return session
+
+@app.put("/uploads/{upload_id}", response_model=schemas.UploadSession)
+async def upload_chunk(upload_id: str, request: Request, response: Response):
+    offset = request.headers.get("upload-offset")
+    if offset is None or not offset.isdigit():
+        raise HTTPException(status_code=400, detail="Upload-Offset header is required")
+    session = await uploads.append_chunk(upload_id, int(offset), request.stream())
+    response.headers.update(upload_session_headers(request, session))
+    return session
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str):
+    summary = await uploads.finalize(upload_id)
+    if summary["failed"]:
+        # The session is kept: retry finalize once Orthanc is back, or DELETE it
+        return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=summary)
+    return summary
+
+@app.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(upload_id: str):
+    await uploads.abort(upload_id)
+
+
+STUDIES_MAX_PAGE_SIZE = 1000
+
+STUDY_SORT_KEYS = {
+    "LastUpdate": {"Type": "Metadata", "Key": "LastUpdate"},
+    "PatientName": {"Type": "DicomTag", "Key": "PatientName"},
+    "StudyDate": {"Type": "DicomTag", "Key": "StudyDate"},
+}
+
+def encode_cursor(since: int, sort: Optional[str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"since": since, "sort": sort}).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[int, Optional[str]]:
     try:
-        studies_response = OrthancAPI.get_studies()
-        studies = []
-
-        async with httpx.AsyncClient() as client:
-            for study_id in studies_response:
-                study_details = await fetch_study_details(client, study_id)  # Передаем клиент здесь
-                study_info = {
-                    "ID": study_details.get("ID"),
-                    "LastUpdate": study_details.get("LastUpdate"),
-                    "MedicalCardNumber": study_details.get("MainDicomTags", {}).get("MedicalCardNumber"),
-                    "StudyInstanceUID": study_details.get("MainDicomTags", {}).get("StudyInstanceUID"),
-                    "PatientBirthDate": study_details.get("PatientMainDicomTags", {}).get("PatientBirthDate"),
-                    "PatientName": study_details.get("PatientMainDicomTags", {}).get("PatientName"),
-                }
-                studies.append(study_info)
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        since = data["since"]
+        if not isinstance(since, int) or since < 0:
+            raise ValueError(since)
+        return since, data.get("sort")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def study_order_by(sort: Optional[str]) -> list[dict]:
+    if not sort:
+        return []
+    direction = "DESC" if sort.startswith("-") else "ASC"
+    key = STUDY_SORT_KEYS.get(sort.lstrip("-"))
+    if key is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported sort key: {sort}")
+    return [{**key, "Direction": direction}]
 
+@app.get("/studies/", response_model=list[schemas.Study])
+async def get_studies(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=STUDIES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    since: Optional[int] = Query(None, ge=0),
+    sort: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    return await list_studies(db, response, {}, limit, cursor, since, sort)
+
+@app.get("/studies/search", response_model=list[schemas.Study])
+async def search_studies(
+    response: Response,
+    PatientName: Optional[str] = None,
+    StudyDateFrom: Optional[str] = None,
+    StudyDateTo: Optional[str] = None,
+    Modality: Optional[str] = None,
+    StudyInstanceUID: Optional[str] = None,
+    MedicalCardNumber: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=STUDIES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    since: Optional[int] = Query(None, ge=0),
+    sort: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    # PatientName accepts Orthanc wildcards (* and ?), Modality a comma-separated list
+    query = {}
+    if PatientName:
+        query["PatientName"] = PatientName
+    if StudyDateFrom or StudyDateTo:
+        query["StudyDate"] = f"{dicom_date(StudyDateFrom)}-{dicom_date(StudyDateTo)}"
+    if Modality:
+        query["ModalitiesInStudy"] = "\\".join(m.strip().upper() for m in Modality.split(",") if m.strip())
+    if StudyInstanceUID:
+        query["StudyInstanceUID"] = StudyInstanceUID
+    if MedicalCardNumber:
+        query["MedicalCardNumber"] = MedicalCardNumber
+    return await list_studies(db, response, query, limit, cursor, since, sort)
+
+def dicom_date(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    date = value.replace("-", "")
+    if len(date) != 8 or not date.isdigit():
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}, expected YYYYMMDD or YYYY-MM-DD")
+    return date
+
+async def list_studies(db: AsyncSession, response: Response, query: dict, limit: Optional[int],
+                       cursor: Optional[str], since: Optional[int], sort: Optional[str]) -> list[dict]:
+    if cursor is not None:
+        # The cursor remembers the sort order of the page it was issued for
+        since, sort = decode_cursor(cursor)
+    order_by = study_order_by(sort)
+    try:
+        # Ask for one extra study to know whether another page exists
+        page_limit = limit + 1 if limit else None
+        if study_index.STUDY_INDEX_ENABLED:
+            rows = await crud.list_indexed_studies(db, query, limit=page_limit, since=since, sort=sort)
+            studies = [study_index.study_from_index(row) for row in rows]
+        else:
+            client = orthanc_client.get_client()
+            studies_response = await find_studies(client, query, limit=page_limit, since=since, order_by=order_by)
+            studies = [study_from_orthanc(study_details) for study_details in studies_response]
+        if limit and len(studies) > limit:
+            studies = studies[:limit]
+            response.headers["X-Next-Cursor"] = encode_cursor((since or 0) + limit, sort)
         return studies
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching studies: {str(e)}")
 
-async def fetch_study_details(client, study_id):
-    orthanc_server_url = "http://orthanc:8042"  # замените на фактический адрес Orthanc
-    response = await client.get(f"{orthanc_server_url}/studies/{study_id}")
+def study_from_orthanc(study_details: dict) -> dict:
+    main_tags = study_details.get("MainDicomTags", {})
+    patient_tags = study_details.get("PatientMainDicomTags", {})
+    return {
+        "ID": study_details.get("ID"),
+        "LastUpdate": study_details.get("LastUpdate"),
+        "MedicalCardNumber": main_tags.get("MedicalCardNumber"),
+        "StudyInstanceUID": main_tags.get("StudyInstanceUID"),
+        "PatientBirthDate": patient_tags.get("PatientBirthDate"),
+        "PatientName": patient_tags.get("PatientName"),
+        "StudyDate": main_tags.get("StudyDate"),
+    }
+
+async def find_studies(client, query: dict, limit: Optional[int] = None, since: Optional[int] = None,
+                       order_by: Optional[list[dict]] = None) -> list[dict]:
+    # One /tools/find round trip returns every matching study with its tags expanded
+    body = {
+        "Level": "Study",
+        "Query": query,
+        "Expand": True,
+    }
+    if limit:
+        body["Limit"] = limit
+    if since:
+        body["Since"] = since
+    if order_by:
+        body["OrderBy"] = order_by
+    response = await orthanc_client.request(client, "POST", "/tools/find", retry=True, json=body)
     response.raise_for_status()
     return response.json()
 
+async def fetch_study_details(client, study_id):
+    study_details = metadata_cache.studies.get(study_id)
+    if study_details is None:
+        fetched_at = metadata_cache.version
+        study_details = await orthanc_client.get_json(client, f"/studies/{study_id}", fetched_at)
+        metadata_cache.remember_study(study_id, study_details, fetched_at)
+    return study_details
+
 
 @app.delete("/studies/{study_id}/", status_code=status.HTTP_204_NO_CONTENT, response_class=JSONResponse)
 async def delete_study(study_id: str):
     try:
-        OrthancAPI.delete_studies_id(study_id)
+        await delete_orthanc_study(study_id)
         return {"message": "Study successfully deleted"}
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Study not found: {str(e)}")
+    except httpx.HTTPStatusError as exc:
+        raise HTTPException(status_code=exc.response.status_code, detail=f"Error deleting study: {exc.response.text}")
+
+BULK_DELETE_CONCURRENCY = int(os.getenv("BULK_DELETE_CONCURRENCY", "4"))
+
+@app.post("/studies/bulk-delete", response_model=schemas.BackgroundJob, status_code=status.HTTP_202_ACCEPTED)
+async def bulk_delete_studies(delete_request: schemas.BulkDeleteRequest):
+    job = background_jobs.start_job("bulk-delete", dict.fromkeys(delete_request.study_ids),
+                                    delete_orthanc_study, BULK_DELETE_CONCURRENCY)
+    return job.to_dict()
+
+@app.get("/studies/bulk-delete/{job_id}", response_model=schemas.BackgroundJob)
+async def get_bulk_delete_job(job_id: str):
+    job = background_jobs.get_job(job_id)
+    if not job or job.kind != "bulk-delete":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+async def delete_orthanc_study(study_id: str):
+    # Only a 404 from Orthanc means the study is gone; timeouts and outages surface as such
+    client = orthanc_client.get_client()
+    instance_ids = await dedup.study_instances(client, study_id)
+    response = await orthanc_client.request(client, "DELETE", f"/studies/{study_id}", retry=True)
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Study not found")
+    response.raise_for_status()
+    await invalidate_deleted_study(study_id, instance_ids)
+
+async def invalidate_deleted_study(study_id: str, instance_ids: list[str]):
+    # The change feed would catch up on its own, but listings must not show the study meanwhile
+    await metadata_cache.invalidate("Study", study_id, deleted=True)
+    await archive_cache.forget(study_id)
+    # A re-upload right after the delete must go through
+    for instance_id in instance_ids:
+        dedup.forget(instance_id)
+    if study_index.STUDY_INDEX_ENABLED:
+        async with AsyncSessionLocal() as db:
+            await crud.delete_indexed_studies(db, [study_id])
+            await db.commit()
 
 
 @app.get("/studies/{study_id}/series", response_model=list[schemas.Series])
-async def get_series_for_study(study_id: str):
+async def get_series_for_study(study_id: str, request: Request, response: Response):
     try:
-        async with httpx.AsyncClient() as client:
+        client = orthanc_client.get_client()
+
+        study_details = await fetch_study_details(client, study_id)
 
-            study_details = await fetch_study_details(client, study_id)
+        etag = http_cache.make_etag("study", study_id, study_details.get("LastUpdate"))
+        if http_cache.is_not_modified(request, etag):
+            return http_cache.not_modified(etag, http_cache.REVALIDATE_CACHE_CONTROL)
+        response.headers.update(http_cache.cache_headers(etag, http_cache.REVALIDATE_CACHE_CONTROL))
 
-            series_ids = study_details.get("Series", [])
+        series_ids = study_details.get("Series", [])
 
-            series_info_list = await fetch_series_details(client, series_ids)
+        series_info_list = await fetch_series_details(client, series_ids)
 
         return series_info_list
 
     except httpx.HTTPStatusError as exc:
         raise HTTPException(status_code=exc.response.status_code,
                             detail=f"Error retrieving series: {exc.response.text}")
+    except HTTPException:
+        raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(exc)}")
 
 
 async def fetch_series_details(client, series_ids):
-    series_info_list = []
-    for series_id in series_ids:
-        # Fetch series details
-        series_info = await fetch_series_info(client, series_id)
+    # Fetch series details, several series at a time
+    series_infos = await orthanc_client.gather_bounded(
+        lambda series_id: fetch_series_info(client, series_id),
+        series_ids
+    )
 
+    series_info_list = []
+    for series_id, series_info in zip(series_ids, series_infos):
         # Add formatted series info to the list
         series_info_list.append({
             "series_id": series_id,
@@ -288,36 +531,70 @@ async def fetch_series_details(client, series_ids):
 
 
 async def fetch_series_info(client, series_id):
-    orthanc_server_url = "http://orthanc:8042"
-    response_series = await client.get(f"{orthanc_server_url}/series/{series_id}")
-    response_series.raise_for_status()
-    return response_series.json()
+    series_info = metadata_cache.series.get(series_id)
+    if series_info is None:
+        fetched_at = metadata_cache.version
+        series_info = await orthanc_client.get_json(client, f"/series/{series_id}", fetched_at)
+        metadata_cache.remember_series(series_id, series_info, fetched_at)
+    return series_info
 
 
 @app.get("/series/{series_id}/instances", response_model=list[str])
-async def get_instances_for_series(series_id: str):
+async def get_instances_for_series(series_id: str, request: Request, response: Response):
     try:
-        async with httpx.AsyncClient() as client:
-            series_info = await fetch_series_info(client, series_id)
+        client = orthanc_client.get_client()
+        series_info = await fetch_series_info(client, series_id)
+        study_details = await fetch_study_details(client, series_info.get("ParentStudy"))
+
+        etag = http_cache.make_etag("series", series_id, study_details.get("LastUpdate"))
+        if http_cache.is_not_modified(request, etag):
+            return http_cache.not_modified(etag, http_cache.REVALIDATE_CACHE_CONTROL)
+        headers = http_cache.cache_headers(etag, http_cache.REVALIDATE_CACHE_CONTROL)
 
         instances = series_info.get("Instances", [])
+        if orthanc_client.ORTHANC_PASSTHROUGH:
+            # The IDs are plain strings already, skip response_model validation and re-serialization
+            return JSONResponse(content=instances, headers=headers)
+        response.headers.update(headers)
         return instances
 
     except httpx.HTTPStatusError as exc:
         raise HTTPException(status_code=exc.response.status_code,
                             detail=f"Error retrieving instances: {exc.response.text}")
+    except HTTPException:
+        raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(exc)}")
 
 
 @app.get("/instances/{instance_id}/tags", response_model=dict)
-async def get_dicom_tags_for_instance(instance_id: str):
+async def get_dicom_tags_for_instance(instance_id: str, request: Request):
     try:
-        async with httpx.AsyncClient() as client:
-            instance_info = await fetch_instance_info(client, instance_id)
+        etag = http_cache.make_etag("instance", instance_id)
+        if http_cache.is_not_modified(request, etag):
+            # The ETag only depends on the id, a deleted instance must not be confirmed from it
+            if metadata_cache.instances.peek(instance_id) is None:
+                response = await orthanc_client.request(orthanc_client.get_client(), "GET", f"/instances/{instance_id}")
+                if response.status_code == 404:
+                    raise HTTPException(status_code=404, detail="Instance not found")
+                response.raise_for_status()
+            return http_cache.not_modified(etag, http_cache.IMMUTABLE_CACHE_CONTROL)
+        headers = http_cache.cache_headers(etag, http_cache.IMMUTABLE_CACHE_CONTROL)
+
+        # Cached tags are answered directly; only a miss is relayed from Orthanc still encoded
+        instance_info = metadata_cache.instances.get(instance_id)
+        if instance_info is None and orthanc_client.ORTHANC_PASSTHROUGH:
+            return await orthanc_client.passthrough(
+                f"/instances/{instance_id}/simplified-tags",
+                accept_encoding=request.headers.get("accept-encoding"),
+                headers=headers
+            )
+
+        if instance_info is None:
+            instance_info = await fetch_instance_info(orthanc_client.get_client(), instance_id)
 
         all_tags = instance_info.get("DicomTags", instance_info)
-        return all_tags
+        return JSONResponse(content=all_tags, headers=headers)
 
     except HTTPException as exc:
         raise exc
@@ -325,12 +602,57 @@ async def get_dicom_tags_for_instance(instance_id: str):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(exc)}")
 
 
+BATCH_TAGS_STREAM_THRESHOLD = 500
+
+@app.post("/instances/tags", response_model=list[schemas.InstanceTags])
+async def get_dicom_tags_for_instances(tags_request: schemas.InstanceTagsRequest):
+    client = orthanc_client.get_client()
+    instance_ids = list(tags_request.instance_ids or [])
+    if tags_request.series_id:
+        try:
+            series_info = await fetch_series_info(client, tags_request.series_id)
+        except httpx.HTTPStatusError as exc:
+            raise HTTPException(status_code=exc.response.status_code,
+                                detail=f"Error retrieving instances: {exc.response.text}")
+        instance_ids.extend(series_info.get("Instances", []))
+    if not instance_ids:
+        raise HTTPException(status_code=400, detail="Either instance_ids or series_id is required")
+
+    if len(instance_ids) > BATCH_TAGS_STREAM_THRESHOLD:
+        return StreamingResponse(stream_instances_tags(client, instance_ids, tags_request.tags),
+                                 media_type="application/x-ndjson")
+    return await fetch_instances_tags(client, instance_ids, tags_request.tags)
+
+async def fetch_instances_tags(client, instance_ids: list[str], tags: Optional[list[str]]) -> list[dict]:
+    async def fetch(instance_id):
+        try:
+            instance_info = await fetch_instance_info(client, instance_id)
+        except HTTPException as exc:
+            return {"ID": instance_id, "Error": str(exc.detail)}
+        except Exception as exc:
+            return {"ID": instance_id, "Error": str(exc)}
+        if tags:
+            instance_info = {tag: instance_info[tag] for tag in tags if tag in instance_info}
+        return {"ID": instance_id, "Tags": instance_info}
+
+    return await orthanc_client.gather_bounded(fetch, instance_ids)
+
+async def stream_instances_tags(client, instance_ids: list[str], tags: Optional[list[str]]):
+    # Large batches go out as NDJSON, one window of concurrent fetches at a time
+    window = orthanc_client.ORTHANC_FANOUT_LIMIT * 4
+    for start in range(0, len(instance_ids), window):
+        for item in await fetch_instances_tags(client, instance_ids[start:start + window], tags):
+            yield json.dumps(item) + "\n"
+
 async def fetch_instance_info(client: httpx.AsyncClient, instance_id: str) -> dict:
-    orthanc_server_url = "http://orthanc:8042"
+    instance_info = metadata_cache.instances.get(instance_id)
+    if instance_info is not None:
+        return instance_info
     try:
-        response_instance = await client.get(f"{orthanc_server_url}/instances/{instance_id}/simplified-tags")
-        response_instance.raise_for_status()
-        return response_instance.json()
+        fetched_at = metadata_cache.version
+        instance_info = await orthanc_client.get_json(client, f"/instances/{instance_id}/simplified-tags", fetched_at)
+        metadata_cache.remember_instance(instance_id, instance_info, fetched_at)
+        return instance_info
     except httpx.HTTPStatusError as exc:
         raise HTTPException(status_code=exc.response.status_code, detail=f"Error retrieving DICOM tags: {exc.response.text}")
 
@@ -338,53 +660,124 @@ async def fetch_instance_info(client: httpx.AsyncClient, instance_id: str) -> di
 @app.websocket("/ws/archive-status")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    # Fairness is per user. Behind nginx every client has the same address, so a socket without
+    # a valid session counts as a user of its own
+    user = auth.decode_access_token(websocket.cookies.get("authToken")) or f"anonymous-{secrets.token_hex(8)}"
+    # Requests sent while a job is being monitored, handled once it is over
+    received = deque()
     try:
         while True:
-            study_id = await websocket.receive_text()
-            job_id = await start_dicom_archive_creation(study_id)
-            await monitor_job_status(websocket, study_id, job_id)
+            message = received.popleft() if received else await websocket.receive_text()
+            study_id, priority = parse_archive_request(message)
+            try:
+                job = archive_jobs.start(study_id, user, priority)
+            except archive_jobs.ArchiveQueueFull as e:
+                await websocket.send_json({"Progress": 0, "State": "Rejected", "Detail": str(e)})
+                continue
+            await monitor_job_status(websocket, study_id, job, received)
     except WebSocketDisconnect:
         pass
 
-async def start_dicom_archive_creation(study_id: str) -> str:
-    async with httpx.AsyncClient(timeout=None) as client:
-        response = await client.post(
-            f"{orthanc_url}/studies/{study_id}/archive",
-            json={"Asynchronous": True}
-        )
-        response.raise_for_status()
-        job_info = response.json()
-        return job_info["ID"]
-
-async def monitor_job_status(websocket: WebSocket, study_id: str, job_id: str):
-    async with httpx.AsyncClient(timeout=None) as client:
-        job_url = f"{orthanc_url}/jobs/{job_id}"
+def parse_archive_request(message: str) -> tuple[str, str]:
+    # Either a bare study id, as before, or {"study_id": ..., "priority": "urgent" | "normal" | "bulk"}
+    try:
+        archive_request = json.loads(message)
+    except ValueError:
+        return message, archive_jobs.DEFAULT_PRIORITY
+    if not isinstance(archive_request, dict):
+        return message, archive_jobs.DEFAULT_PRIORITY
+    return archive_request.get("study_id", ""), archive_request.get("priority", archive_jobs.DEFAULT_PRIORITY)
+
+def take_message(message: dict, received: deque):
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        received.append(message["text"])
+
+async def monitor_job_status(websocket: WebSocket, study_id: str, job: archive_jobs.ArchiveJob, received: deque):
+    # Statuses come from the scheduler and the shared poller, this socket never polls Orthanc itself.
+    # The socket is read at the same time, so a client that goes away unsubscribes at once
+    # instead of on the next send, which may be a long time away for a queued job
+    updates = archive_jobs.subscribe(job)
+    receiving = asyncio.create_task(websocket.receive())
+    try:
         while True:
-            response = await client.get(job_url)
-            response.raise_for_status()
-            job_status = response.json()
-
-            await websocket.send_json({
-                "Progress": job_status.get("Progress", 0),
-                "State": job_status.get("State", "Unknown")
-            })
-
-            if job_status["Progress"] == 100 and job_status["State"] == "Success":
-                await websocket.send_text(f"Job completed: {job_id}")
+            getting = asyncio.create_task(updates.get())
+            await asyncio.wait({receiving, getting}, return_when=asyncio.FIRST_COMPLETED)
+            if receiving.done():
+                take_message(receiving.result(), received)
+                receiving = asyncio.create_task(websocket.receive())
+            if not getting.done():
+                getting.cancel()
+                continue
+            job_status = getting.result()
+            await websocket.send_json(job_status)
+
+            if job_status.get("Progress") == 100 and job_status["State"] == "Success":
+                await websocket.send_text(f"Job completed: {job.job_id}")
                 break
 
-            await asyncio.sleep(2)
+            if job_status["State"] in archive_jobs.FINAL_STATES:
+                break
+    finally:
+        archive_jobs.unsubscribe(job, updates)
+        if not receiving.done():
+            receiving.cancel()
+        elif not receiving.cancelled() and receiving.exception() is None:
+            take_message(receiving.result(), received)
+
+@app.post("/internal/jobs/events", status_code=status.HTTP_204_NO_CONTENT)
+async def receive_job_events(events: schemas.JobEvents, x_job_events_token: Optional[str] = Header(None)):
+    # Called by the Orthanc Python plugin (orthanc_config/handlers.py) on job progress and completion
+    # Fails closed: without a configured token nobody may mark jobs as done, the poller still works
+    if not archive_jobs.JOB_EVENTS_TOKEN or not secrets.compare_digest(x_job_events_token or "", archive_jobs.JOB_EVENTS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid job events token")
+    archive_jobs.apply_events([event.model_dump() for event in events.jobs])
+
+@app.post("/download/bundle")
+async def download_dicom_bundle(bundle_request: schemas.BundleRequest):
+    study_ids = list(dict.fromkeys(bundle_request.study_ids))
+    return StreamingResponse(
+        bundle.stream_bundle(study_ids, bundle_request.layout),
+        media_type="application/zip",
+        headers={'Content-Disposition': f'attachment; filename="studies-{len(study_ids)}.zip"'}
+    )
 
 @app.get("/download/{study_id}")
-def download_dicom_archive(study_id: str):
-    with httpx.Client(timeout=None) as client:
-        response = client.get(f"{orthanc_url}/studies/{study_id}/archive")
-        response.raise_for_status()
+async def download_dicom_archive(study_id: str, request: Request):
+    last_update = None
+    if archive_cache.ARCHIVE_CACHE_ENABLED:
+        try:
+            last_update = (await fetch_study_details(orthanc_client.get_client(), study_id)).get("LastUpdate")
+        except httpx.HTTPStatusError:
+            pass
+        archive_path = archive_cache.lookup(study_id, last_update)
+        if archive_path:
+            # Served from disk with Range support, zero-copy where the server implements it
+            return FileResponse(archive_path, media_type="application/zip", filename=f"{study_id}.zip")
+
+    # Range/If-Range go to Orthanc; a 206 with Content-Range is relayed as is
+    response = await orthanc_client.passthrough(
+        f"/studies/{study_id}/archive",
+        headers={'Content-Type': 'application/zip', 'Content-Disposition': f'attachment; filename="{study_id}.zip"'},
+        request_headers=request.headers,
+        timeout=orthanc_client.stream_timeout()
+    )
+    if response.status_code == 200:
+        response.body_iterator = archive_cache.tee(study_id, last_update, response.body_iterator)
+    return response
 
-        if response.is_error:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
 
-        return StreamingResponse(content=response.iter_bytes(), media_type='application/zip', headers={'Content-Disposition': f'attachment; filename="{study_id}.zip"'})
+@app.get("/metrics/")
+async def get_metrics():
+    return {
+        "metadata_cache": metadata_cache.stats(),
+        "single_flight": orthanc_client.flights.stats(),
+        "orthanc_circuit_breaker": orthanc_client.breaker.stats(),
+        "upload_dedup": dedup.stats(),
+        "archive_cache": archive_cache.stats(),
+        "archive_jobs": archive_jobs.stats(),
+    }
 
 
 if __name__ == "__main__":
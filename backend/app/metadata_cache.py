@@ -0,0 +1,104 @@
+import os
+from typing import Optional
+
+from backend.app import changes, orthanc_client
+from backend.app.cache import LRUCache
+
+STUDY_CACHE_SIZE = int(os.getenv("STUDY_CACHE_SIZE", "10000"))
+SERIES_CACHE_SIZE = int(os.getenv("SERIES_CACHE_SIZE", "50000"))
+INSTANCE_CACHE_SIZE = int(os.getenv("INSTANCE_CACHE_SIZE", "5000"))
+PARENT_INDEX_SIZE = int(os.getenv("PARENT_INDEX_SIZE", "500000"))
+
+studies = LRUCache(STUDY_CACHE_SIZE)
+series = LRUCache(SERIES_CACHE_SIZE)
+instances = LRUCache(INSTANCE_CACHE_SIZE)
+
+# child id -> parent id (instance -> series, series -> study), learned from cached objects
+parents = LRUCache(PARENT_INDEX_SIZE)
+
+CACHES = {"Study": studies, "Series": series, "Instance": instances}
+PARENT_LEVELS = {"Instance": ("Series", "ParentSeries", "instances"), "Series": ("Study", "ParentStudy", "series")}
+
+# Bumped on every eviction so that a fetch racing with a change does not store stale data
+version = 0
+
+
+def remember_study(study_id: str, study_details: dict, fetched_at: int):
+    if fetched_at != version:
+        return
+    studies.set(study_id, study_details)
+    for series_id in study_details.get("Series", []):
+        parents.set(series_id, study_id)
+
+
+def remember_series(series_id: str, series_info: dict, fetched_at: int):
+    if fetched_at != version:
+        return
+    series.set(series_id, series_info)
+    if series_info.get("ParentStudy"):
+        parents.set(series_id, series_info["ParentStudy"])
+    for instance_id in series_info.get("Instances", []):
+        parents.set(instance_id, series_id)
+
+
+def remember_instance(instance_id: str, instance_info: dict, fetched_at: int):
+    if fetched_at == version:
+        instances.set(instance_id, instance_info)
+
+
+def drop(level: str, resource_id: str, descendants: bool = False):
+    global version
+    version += 1
+    value = CACHES[level].pop(resource_id)
+    if not descendants or value is None:
+        return
+    if level == "Study":
+        for series_id in value.get("Series", []):
+            drop("Series", series_id, descendants=True)
+    elif level == "Series":
+        for instance_id in value.get("Instances", []):
+            instances.pop(instance_id)
+
+
+async def lookup_parent(level: str, resource_id: str) -> Optional[str]:
+    parent_level, parent_key, path = PARENT_LEVELS[level]
+    parent_id = parents.peek(resource_id)
+    if parent_id is None and any(len(CACHES[lvl]) for lvl in ("Study", "Series")):
+        # Change records carry no parent id. Resolved parents are kept, so during an upload the series
+        # is resolved to its study once rather than again for every new instance
+        response = await orthanc_client.request(orthanc_client.get_client(), "GET", f"/{path}/{resource_id}")
+        if response.is_success:
+            parent_id = response.json().get(parent_key)
+            if parent_id:
+                parents.set(resource_id, parent_id)
+    return parent_id
+
+
+async def invalidate(level: str, resource_id: str, deleted: bool = False):
+    # Evicts the resource and every cached ancestor whose children or LastUpdate changed with it
+    if level not in CACHES:
+        return
+    drop(level, resource_id, descendants=deleted)
+    while level in PARENT_LEVELS:
+        parent_level = PARENT_LEVELS[level][0]
+        parent_id = parents.peek(resource_id) if deleted else await lookup_parent(level, resource_id)
+        if parent_id is None:
+            break
+        drop(parent_level, parent_id)
+        level, resource_id = parent_level, parent_id
+
+
+async def on_change(change: dict):
+    await invalidate(change.get("ResourceType"), change.get("ID"), deleted=change.get("ChangeType") == "Deleted")
+
+
+def stats() -> dict:
+    return {
+        "studies": studies.stats(),
+        "series": series.stats(),
+        "instances": instances.stats(),
+        "last_change": changes.last_seq,
+    }
+
+
+changes.subscribe(on_change)
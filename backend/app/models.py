@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import Boolean, Column, Index, Integer, String, func
 from sqlalchemy.orm import DeclarativeBase
 
 class Base(DeclarativeBase):
@@ -21,3 +21,28 @@ class News(Base):
     content = Column(String)
     image = Column(String, nullable=True)
 
+class StudyIndex(Base):
+    __tablename__ = "studies"
+
+    # Mirror of Orthanc's study metadata, kept in sync from the /changes feed
+    id = Column(String, primary_key=True)
+    study_instance_uid = Column(String, index=True)
+    patient_name = Column(String, index=True)
+    patient_birth_date = Column(String)
+    medical_card_number = Column(String, index=True)
+    study_date = Column(String, index=True)
+    modalities = Column(String)
+    last_update = Column(String, index=True)
+
+    __table_args__ = (
+        # Serves the case-insensitive PatientName search, lower(patient_name) LIKE 'doe%'
+        Index("ix_studies_patient_name_lower", func.lower(patient_name).label("patient_name_lower"),
+              postgresql_ops={"patient_name_lower": "text_pattern_ops"}),
+    )
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    name = Column(String, primary_key=True)
+    last_change = Column(Integer, nullable=False)
+
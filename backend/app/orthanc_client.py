@@ -0,0 +1,246 @@
+import asyncio
+import os
+import random
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+import httpx
+from fastapi import HTTPException
+from pyorthanc import AsyncOrthanc
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+from backend.app.circuit_breaker import CircuitBreaker, CircuitOpenError
+from backend.app.singleflight import SingleFlight
+
+ORTHANC_URL = os.getenv("ORTHANC_URL", "http://orthanc:8042")
+
+ORTHANC_MAX_CONNECTIONS = int(os.getenv("ORTHANC_MAX_CONNECTIONS", "100"))
+ORTHANC_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("ORTHANC_MAX_KEEPALIVE_CONNECTIONS", "20"))
+ORTHANC_KEEPALIVE_EXPIRY = float(os.getenv("ORTHANC_KEEPALIVE_EXPIRY", "30"))
+
+ORTHANC_CONNECT_TIMEOUT = float(os.getenv("ORTHANC_CONNECT_TIMEOUT", "5"))
+ORTHANC_READ_TIMEOUT = float(os.getenv("ORTHANC_READ_TIMEOUT", "30"))
+ORTHANC_POOL_TIMEOUT = float(os.getenv("ORTHANC_POOL_TIMEOUT", "10"))
+# Read timeout between two chunks of a long streamed response such as an archive
+ORTHANC_STREAM_READ_TIMEOUT = float(os.getenv("ORTHANC_STREAM_READ_TIMEOUT", "300"))
+
+# Overall budget for one call, retries and backoff included
+ORTHANC_DEADLINE = float(os.getenv("ORTHANC_DEADLINE", "60"))
+ORTHANC_RETRIES = int(os.getenv("ORTHANC_RETRIES", "3"))
+ORTHANC_RETRY_BACKOFF = float(os.getenv("ORTHANC_RETRY_BACKOFF", "0.2"))
+ORTHANC_RETRY_BACKOFF_MAX = float(os.getenv("ORTHANC_RETRY_BACKOFF_MAX", "5"))
+RETRY_STATUS_CODES = {502, 503, 504}
+
+ORTHANC_BREAKER_THRESHOLD = int(os.getenv("ORTHANC_BREAKER_THRESHOLD", "5"))
+ORTHANC_BREAKER_RESET_TIMEOUT = float(os.getenv("ORTHANC_BREAKER_RESET_TIMEOUT", "30"))
+
+ORTHANC_FANOUT_LIMIT = int(os.getenv("ORTHANC_FANOUT_LIMIT", "16"))
+
+ORTHANC_SINGLE_FLIGHT = os.getenv("ORTHANC_SINGLE_FLIGHT", "1") == "1"
+
+ORTHANC_PASSTHROUGH = os.getenv("ORTHANC_PASSTHROUGH", "1") == "1"
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+PASSTHROUGH_HEADERS = ("content-type", "content-length", "content-encoding", "content-range", "accept-ranges")
+# Request headers worth forwarding to Orthanc, e.g. to resume an interrupted download
+FORWARDED_REQUEST_HEADERS = ("range", "if-range")
+
+_client: Optional[AsyncOrthanc] = None
+
+flights = SingleFlight()
+
+breaker = CircuitBreaker(ORTHANC_BREAKER_THRESHOLD, ORTHANC_BREAKER_RESET_TIMEOUT)
+
+
+class OrthancUnavailable(HTTPException):
+    def __init__(self, detail: str, status_code: int = 503):
+        super().__init__(status_code=status_code, detail=detail)
+
+
+def create_client() -> AsyncOrthanc:
+    limits = httpx.Limits(
+        max_connections=ORTHANC_MAX_CONNECTIONS,
+        max_keepalive_connections=ORTHANC_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=ORTHANC_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        ORTHANC_READ_TIMEOUT,
+        connect=ORTHANC_CONNECT_TIMEOUT,
+        pool=ORTHANC_POOL_TIMEOUT,
+    )
+    # AsyncOrthanc is an httpx.AsyncClient, so raw requests and pyorthanc calls share one pool
+    return AsyncOrthanc(ORTHANC_URL, base_url=ORTHANC_URL, limits=limits, timeout=timeout)
+
+
+async def open_client() -> AsyncOrthanc:
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> AsyncOrthanc:
+    if _client is None:
+        raise RuntimeError("Orthanc client is not initialised, the application lifespan has not started")
+    return _client
+
+
+async def gather_bounded(func: Callable[[Any], Awaitable[Any]], items: Iterable[Any],
+                         limit: int = ORTHANC_FANOUT_LIMIT, return_exceptions: bool = False) -> list:
+    # Results keep the order of items; at most `limit` calls are in flight at once
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=return_exceptions)
+
+
+def stream_timeout() -> httpx.Timeout:
+    return httpx.Timeout(ORTHANC_STREAM_READ_TIMEOUT, connect=ORTHANC_CONNECT_TIMEOUT, pool=ORTHANC_POOL_TIMEOUT)
+
+
+def retry_delay(attempt: int) -> float:
+    # Full jitter, so that retries from many requests do not hit Orthanc in lockstep
+    return random.uniform(0, min(ORTHANC_RETRY_BACKOFF_MAX, ORTHANC_RETRY_BACKOFF * 2 ** attempt))
+
+
+async def request(client: httpx.AsyncClient, method: str, path: str, retry: Optional[bool] = None,
+                  deadline: Optional[float] = ORTHANC_DEADLINE, **kwargs) -> httpx.Response:
+    # GETs are retried by default; other methods only when the caller knows they are idempotent
+    attempts = ORTHANC_RETRIES + 1 if (method == "GET" if retry is None else retry) else 1
+
+    async def call():
+        for attempt in range(attempts):
+            try:
+                breaker.before_call()
+            except CircuitOpenError as exc:
+                raise OrthancUnavailable(str(exc))
+            try:
+                response = await client.request(method, path, **kwargs)
+            except asyncio.CancelledError:
+                breaker.abandon_call()
+                raise
+            except httpx.TransportError as exc:
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise OrthancUnavailable(f"Orthanc is unreachable: {str(exc)}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    return response
+            await asyncio.sleep(retry_delay(attempt))
+
+    try:
+        return await asyncio.wait_for(call(), deadline)
+    except asyncio.TimeoutError:
+        raise OrthancUnavailable(f"Orthanc did not answer {method} {path} within {deadline}s", status_code=504)
+
+
+@asynccontextmanager
+async def open_stream(client: httpx.AsyncClient, method: str, path: str,
+                      timeout: Optional[httpx.Timeout] = None, **kwargs) -> AsyncIterator[httpx.Response]:
+    # Streaming counterpart of request(): same breaker accounting, but no retries and no overall deadline,
+    # only the read timeout between two chunks
+    try:
+        breaker.before_call()
+    except CircuitOpenError as exc:
+        raise OrthancUnavailable(str(exc))
+    try:
+        response = await client.send(client.build_request(method, path, timeout=timeout or stream_timeout(), **kwargs),
+                                     stream=True)
+    except asyncio.CancelledError:
+        breaker.abandon_call()
+        raise
+    except httpx.TransportError as exc:
+        breaker.record_failure()
+        raise OrthancUnavailable(f"Orthanc is unreachable: {str(exc)}")
+    if response.status_code in RETRY_STATUS_CODES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    try:
+        yield response
+    finally:
+        await response.aclose()
+
+
+async def get_json(client: httpx.AsyncClient, path: str, generation: Optional[int] = None) -> Any:
+    # `generation` is the cache version the caller will store the result under: a caller arriving after
+    # an eviction must not join a flight that started before it and may return stale data
+    async def fetch():
+        response = await request(client, "GET", path)
+        response.raise_for_status()
+        return response.json()
+
+    if not ORTHANC_SINGLE_FLIGHT:
+        return await fetch()
+    return await flights.do((path, generation), fetch)
+
+
+async def passthrough(path: str, accept_encoding: Optional[str] = None, headers: Optional[dict] = None,
+                      request_headers: Optional[dict] = None, timeout: Optional[httpx.Timeout] = None) -> StreamingResponse:
+    # Relays Orthanc's response bytes as they arrive, still encoded, without building Python objects.
+    # Each chunk is only read from Orthanc once the previous one was sent, so a slow client slows the upstream read
+    client = get_client()
+    upstream_headers = {"Accept-Encoding": accept_encoding or "identity"}
+    for name in FORWARDED_REQUEST_HEADERS:
+        if request_headers and name in request_headers:
+            upstream_headers[name] = request_headers[name]
+    upstream_request = client.build_request("GET", path, headers=upstream_headers, timeout=timeout or client.timeout)
+    try:
+        breaker.before_call()
+    except CircuitOpenError as exc:
+        raise OrthancUnavailable(str(exc))
+    try:
+        upstream = await client.send(upstream_request, stream=True)
+    except asyncio.CancelledError:
+        breaker.abandon_call()
+        raise
+    except httpx.HTTPError as exc:
+        breaker.record_failure()
+        raise HTTPException(status_code=502, detail=f"Orthanc is unreachable: {str(exc)}")
+    if upstream.status_code in RETRY_STATUS_CODES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    if upstream.is_error:
+        body = await upstream.aread()
+        await upstream.aclose()
+        status_code = upstream.status_code if upstream.status_code < 500 else 502
+        raise HTTPException(status_code=status_code, detail=body.decode(errors="replace"))
+
+    response_headers = {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS if name in upstream.headers}
+    response_headers["Vary"] = "Accept-Encoding"
+    response_headers.update(headers or {})
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        status_code=upstream.status_code,
+        headers=response_headers,
+        background=BackgroundTask(upstream.aclose),
+    )
+
+
+async def post_instance(body: AsyncIterable[bytes], content_length: Optional[int] = None) -> dict:
+    # The body is sent chunk by chunk as it is produced, nothing is buffered on our side
+    headers = {"Content-Type": "application/dicom"}
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+    response = await request(get_client(), "POST", "/instances", retry=False, deadline=None,
+                             content=body, headers=headers, timeout=stream_timeout())
+    response.raise_for_status()
+    return response.json()
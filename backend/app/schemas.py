@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
 
 class UserCreate(BaseModel):
     username: str
@@ -41,9 +41,54 @@ class Study(BaseModel):
     PatientBirthDate: Optional[str]
     PatientName: Optional[str]
     StudyInstanceUID: Optional[str]
+    StudyDate: Optional[str] = None
 
 class Series(BaseModel):
     series_id: str
     instance_number: Optional[int]
     series_description: Optional[str]
-    number_of_instances: Optional[int]
\ No newline at end of file
+    number_of_instances: Optional[int]
+
+class BulkDeleteRequest(BaseModel):
+    study_ids: list[str]
+
+class BackgroundJob(BaseModel):
+    job_id: str
+    kind: str
+    state: str
+    total: int
+    completed: int
+    failed: int
+    errors: dict[str, str]
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    length: int = Field(..., gt=0)
+
+class UploadSession(BaseModel):
+    upload_id: str
+    filename: str
+    length: int
+    offset: int
+
+class InstanceTagsRequest(BaseModel):
+    instance_ids: Optional[list[str]] = None
+    series_id: Optional[str] = None
+    tags: Optional[list[str]] = None
+
+class InstanceTags(BaseModel):
+    ID: str
+    Tags: Optional[dict] = None
+    Error: Optional[str] = None
+
+class JobEvent(BaseModel):
+    ID: str
+    State: str
+    Progress: int = 0
+
+class JobEvents(BaseModel):
+    jobs: list[JobEvent]
+
+class BundleRequest(BaseModel):
+    study_ids: list[str] = Field(..., min_length=1, max_length=1000)
+    layout: Literal["patient", "study", "series"] = "patient"
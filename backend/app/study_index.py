@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import sys
+
+from backend.app import changes, crud, orthanc_client
+from backend.app.database import AsyncSessionLocal
+
+STUDY_INDEX_ENABLED = os.getenv("STUDY_INDEX_ENABLED", "0") == "1"
+STUDY_INDEX_PAGE_SIZE = int(os.getenv("STUDY_INDEX_PAGE_SIZE", "1000"))
+
+SYNC_STATE_NAME = "studies"
+
+REQUESTED_TAGS = ["ModalitiesInStudy"]
+
+# Study-level changes that may alter the indexed columns
+REFRESH_CHANGES = {"NewStudy", "StableStudy", "UpdatedMetadata", "UpdatedAttachment"}
+# A new series may bring a modality; its study is refreshed without waiting for StableStudy
+REFRESH_SERIES_CHANGES = {"NewSeries"}
+
+
+def study_row(study_details: dict) -> dict:
+    main_tags = study_details.get("MainDicomTags", {})
+    patient_tags = study_details.get("PatientMainDicomTags", {})
+    requested_tags = study_details.get("RequestedTags", {})
+    return {
+        "id": study_details["ID"],
+        "study_instance_uid": main_tags.get("StudyInstanceUID"),
+        "patient_name": patient_tags.get("PatientName"),
+        "patient_birth_date": patient_tags.get("PatientBirthDate"),
+        "medical_card_number": main_tags.get("MedicalCardNumber"),
+        "study_date": main_tags.get("StudyDate"),
+        "modalities": requested_tags.get("ModalitiesInStudy"),
+        "last_update": study_details.get("LastUpdate"),
+    }
+
+
+def study_from_index(row) -> dict:
+    return {
+        "ID": row.id,
+        "LastUpdate": row.last_update,
+        "MedicalCardNumber": row.medical_card_number,
+        "StudyInstanceUID": row.study_instance_uid,
+        "PatientBirthDate": row.patient_birth_date,
+        "PatientName": row.patient_name,
+        "StudyDate": row.study_date,
+    }
+
+
+async def backfill():
+    client = orthanc_client.get_client()
+    # Changes made while the backfill runs are replayed by sync_changes afterwards
+    last_change = (await changes.fetch_changes(client))["Last"]
+    since = 0
+    while True:
+        response = await orthanc_client.request(client, "POST", "/tools/find", retry=True, json={
+            "Level": "Study",
+            "Query": {},
+            "Expand": True,
+            "RequestedTags": REQUESTED_TAGS,
+            "Limit": STUDY_INDEX_PAGE_SIZE,
+            "Since": since,
+        })
+        response.raise_for_status()
+        page = response.json()
+        async with AsyncSessionLocal() as db:
+            await crud.upsert_indexed_studies(db, [study_row(study_details) for study_details in page])
+            await db.commit()
+        since += len(page)
+        logging.info(f"Study index backfill: {since} studies")
+        if len(page) < STUDY_INDEX_PAGE_SIZE:
+            break
+    async with AsyncSessionLocal() as db:
+        await crud.set_sync_state(db, SYNC_STATE_NAME, last_change)
+        await db.commit()
+    return since
+
+
+async def fetch_indexed_study(client, study_id: str):
+    response = await orthanc_client.request(client, "GET", f"/studies/{study_id}",
+                                            params={"requestedTags": ";".join(REQUESTED_TAGS)})
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+async def fetch_parent_study(client, series_id: str):
+    response = await orthanc_client.request(client, "GET", f"/series/{series_id}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json().get("ParentStudy")
+
+
+async def apply_changes(client, change_list: list[dict], last_change: int):
+    # Every study is refreshed at most once per page of changes, however many series arrived for it
+    new_series = {change["ID"] for change in change_list
+                  if change.get("ResourceType") == "Series" and change.get("ChangeType") in REFRESH_SERIES_CHANGES}
+    series_studies = dict(zip(new_series, await orthanc_client.gather_bounded(
+        lambda series_id: fetch_parent_study(client, series_id), new_series)))
+
+    refreshed, deleted = set(), set()
+    for change in change_list:
+        if change.get("ID") in series_studies:
+            if series_studies[change["ID"]] is not None:
+                refreshed.add(series_studies[change["ID"]])
+                deleted.discard(series_studies[change["ID"]])
+            continue
+        if change.get("ResourceType") != "Study":
+            continue
+        if change.get("ChangeType") == "Deleted":
+            deleted.add(change["ID"])
+            refreshed.discard(change["ID"])
+        elif change.get("ChangeType") in REFRESH_CHANGES:
+            refreshed.add(change["ID"])
+            deleted.discard(change["ID"])
+
+    rows = []
+    for study_details in await orthanc_client.gather_bounded(
+            lambda study_id: fetch_indexed_study(client, study_id), refreshed):
+        if study_details is not None:
+            rows.append(study_row(study_details))
+
+    # Rows and the change sequence are committed together so a restart resumes exactly
+    async with AsyncSessionLocal() as db:
+        await crud.upsert_indexed_studies(db, rows)
+        await crud.delete_indexed_studies(db, list(deleted))
+        await crud.set_sync_state(db, SYNC_STATE_NAME, last_change)
+        await db.commit()
+
+
+async def sync_changes():
+    client = orthanc_client.get_client()
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                since = await crud.get_sync_state(db, SYNC_STATE_NAME)
+            if since is None:
+                await backfill()
+                continue
+            page = await changes.fetch_changes(client, since)
+            if page["Last"] != since:
+                await apply_changes(client, page.get("Changes", []), page["Last"])
+            if page.get("Done", True):
+                await asyncio.sleep(changes.CHANGES_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Error syncing study index: {e}")
+            await asyncio.sleep(changes.CHANGES_POLL_INTERVAL)
+
+
+async def main(command: str):
+    await orthanc_client.open_client()
+    try:
+        if command == "backfill":
+            count = await backfill()
+            print(f"Indexed {count} studies")
+        elif command == "sync":
+            await sync_changes()
+        else:
+            raise SystemExit(f"Unknown command: {command}, expected backfill or sync")
+    finally:
+        await orthanc_client.close_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "backfill"))
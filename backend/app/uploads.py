@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import AsyncIterable
+
+import aiofiles
+import aiofiles.os
+from fastapi import HTTPException
+
+from backend.app import ingest
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/tmp/dicom-uploads")
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", "600"))
+
+_locks: dict[str, asyncio.Lock] = {}
+
+
+def _data_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+
+
+def _meta_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+
+
+async def _lock(upload_id: str) -> asyncio.Lock:
+    # Unknown ids are rejected before a lock is created for them, or _locks would grow without bound
+    await get_session(upload_id)
+    return _locks.setdefault(upload_id, asyncio.Lock())
+
+
+async def _write_meta(meta: dict):
+    async with aiofiles.open(_meta_path(meta["upload_id"]), "w") as meta_file:
+        await meta_file.write(json.dumps(meta))
+
+
+async def get_session(upload_id: str) -> dict:
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id) or not await aiofiles.os.path.exists(_meta_path(upload_id)):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    async with aiofiles.open(_meta_path(upload_id)) as meta_file:
+        meta = json.loads(await meta_file.read())
+    # The data file size is the source of truth: bytes written by an interrupted PUT still count
+    meta["offset"] = await aiofiles.os.path.getsize(_data_path(upload_id))
+    return meta
+
+
+async def create_session(filename: str, length: int) -> dict:
+    await aiofiles.os.makedirs(UPLOAD_DIR, exist_ok=True)
+    now = time.time()
+    meta = {"upload_id": uuid.uuid4().hex, "filename": filename, "length": length, "created_at": now, "updated_at": now}
+    async with aiofiles.open(_data_path(meta["upload_id"]), "wb"):
+        pass
+    await _write_meta(meta)
+    meta["offset"] = 0
+    return meta
+
+
+async def append_chunk(upload_id: str, offset: int, body: AsyncIterable[bytes]) -> dict:
+    async with await _lock(upload_id):
+        meta = await get_session(upload_id)
+        if offset != meta["offset"]:
+            raise HTTPException(status_code=409, detail=f"Upload offset mismatch, current offset is {meta['offset']}")
+        written = offset
+        async with aiofiles.open(_data_path(upload_id), "ab") as data_file:
+            async for chunk in body:
+                if written + len(chunk) > meta["length"]:
+                    await data_file.truncate(offset)
+                    raise HTTPException(status_code=413, detail="Chunk exceeds the declared upload length")
+                await data_file.write(chunk)
+                written += len(chunk)
+        meta["updated_at"] = time.time()
+        await _write_meta({key: value for key, value in meta.items() if key != "offset"})
+        meta["offset"] = written
+        return meta
+
+
+async def finalize(upload_id: str) -> dict:
+    async with await _lock(upload_id):
+        meta = await get_session(upload_id)
+        if meta["offset"] != meta["length"]:
+            raise HTTPException(status_code=409,
+                                detail=f"Upload is incomplete: {meta['offset']} of {meta['length']} bytes received")
+        # Same path as the batch endpoint: a ZIP is ingested member by member, anything else as one instance
+        with open(_data_path(upload_id), "rb") as data_file:
+            summary = await ingest.ingest(ingest.iter_sources(data_file, meta["filename"], meta["length"]))
+        # The data stays until every instance is in Orthanc: finalize can be retried, and what was
+        # already stored is skipped by the dedup index
+        if not summary["failed"]:
+            await _remove(upload_id)
+        return summary
+
+
+async def abort(upload_id: str):
+    async with await _lock(upload_id):
+        await get_session(upload_id)
+        await _remove(upload_id)
+
+
+async def _remove(upload_id: str):
+    for path in (_data_path(upload_id), _meta_path(upload_id)):
+        try:
+            await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
+    _locks.pop(upload_id, None)
+
+
+async def collect_abandoned_sessions():
+    while True:
+        try:
+            if await aiofiles.os.path.isdir(UPLOAD_DIR):
+                expired_before = time.time() - UPLOAD_SESSION_TTL
+                for name in await aiofiles.os.listdir(UPLOAD_DIR):
+                    upload_id, extension = os.path.splitext(name)
+                    lock = _locks.get(upload_id)
+                    if extension != ".json" or (lock and lock.locked()):
+                        continue
+                    async with aiofiles.open(_meta_path(upload_id)) as meta_file:
+                        meta = json.loads(await meta_file.read())
+                    if meta["updated_at"] < expired_before:
+                        logging.info(f"Removing abandoned upload session {upload_id}")
+                        await _remove(upload_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Error collecting abandoned uploads: {e}")
+        await asyncio.sleep(UPLOAD_GC_INTERVAL)
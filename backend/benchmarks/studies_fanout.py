@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from backend.app import orthanc_client
+
+# Per-study detail fetches against a simulated Orthanc: one after the other, as GET /studies/ did before,
+# and through orthanc_client.gather_bounded.
+#
+#     python -m backend.benchmarks.studies_fanout --latency 0.005 --counts 10 100 1000
+
+
+def simulated_client(latency: float) -> httpx.AsyncClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        return httpx.Response(200, json={"ID": request.url.path.rsplit("/", 1)[-1], "MainDicomTags": {}})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://orthanc")
+
+
+async def fetch_serial(client: httpx.AsyncClient, study_ids: list[str]) -> list:
+    return [(await client.get(f"/studies/{study_id}")).json() for study_id in study_ids]
+
+
+async def fetch_bounded(client: httpx.AsyncClient, study_ids: list[str], limit: int) -> list:
+    async def fetch(study_id: str):
+        return (await client.get(f"/studies/{study_id}")).json()
+
+    return await orthanc_client.gather_bounded(fetch, study_ids, limit)
+
+
+async def timed(coro) -> float:
+    started = time.perf_counter()
+    await coro
+    return (time.perf_counter() - started) * 1000
+
+
+async def main(latency: float, counts: list[int], limit: int):
+    async with simulated_client(latency) as client:
+        print(f"{'studies':>8} {'serial':>12} {f'bounded({limit})':>14}")
+        for count in counts:
+            study_ids = [f"study-{i}" for i in range(count)]
+            serial = await timed(fetch_serial(client, study_ids))
+            bounded = await timed(fetch_bounded(client, study_ids, limit))
+            print(f"{count:>8} {serial:>9.1f} ms {bounded:>11.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated seconds per Orthanc call")
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--limit", type=int, default=orthanc_client.ORTHANC_FANOUT_LIMIT)
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.counts, args.limit))
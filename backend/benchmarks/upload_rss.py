@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from contextlib import nullcontext
+from functools import partial
+
+import httpx
+
+from backend.app import ingest, orthanc_client
+
+# Peak RSS of one upload relayed to a simulated Orthanc that discards the body. Each pattern runs in a
+# process of its own, ru_maxrss only ever grows:
+#   idle      - imports and client only, what every pattern pays before the upload starts
+#   buffered  - the former upload_dicom: read everything, write a temp file, read it back, post the bytes
+#   streamed  - ingest.store_instance, as /upload-dicom/ does now
+#
+#     python -m backend.benchmarks.upload_rss --size-mb 300
+
+PATTERNS = ("idle", "buffered", "streamed")
+
+
+def peak_rss_mib() -> float:
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class DiscardTransport(httpx.AsyncBaseTransport):
+    # httpx.MockTransport reads the whole request body before calling its handler, this one drains it
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        size = 0
+        async for chunk in request.stream:
+            size += len(chunk)
+        return httpx.Response(200, json={"ID": "benchmark", "Status": "Success", "Size": size})
+
+
+async def upload_buffered(path: str):
+    with open(path, "rb") as upload:
+        content = upload.read()
+    with tempfile.NamedTemporaryFile() as temp_file:
+        temp_file.write(content)
+        temp_file.flush()
+        with open(temp_file.name, "rb") as reopened:
+            content = reopened.read()
+    response = await orthanc_client.get_client().post("/instances", content=content)
+    response.raise_for_status()
+
+
+async def upload_streamed(path: str):
+    with open(path, "rb") as upload:
+        result = await ingest.store_instance(os.path.basename(path), partial(nullcontext, upload), os.path.getsize(path))
+    if result["status"] == "failed":
+        raise RuntimeError(result["error"])
+
+
+async def run(pattern: str, path: str):
+    orthanc_client._client = httpx.AsyncClient(transport=DiscardTransport(), base_url="http://orthanc")
+    try:
+        if pattern == "buffered":
+            await upload_buffered(path)
+        elif pattern == "streamed":
+            await upload_streamed(path)
+    finally:
+        await orthanc_client.close_client()
+
+
+def make_upload(size_mb: int) -> str:
+    with tempfile.NamedTemporaryFile(suffix=".dcm", delete=False) as upload:
+        for _ in range(size_mb):
+            upload.write(os.urandom(1024 * 1024))
+    return upload.name
+
+
+def main(size_mb: int):
+    path = make_upload(size_mb)
+    try:
+        print(f"{'pattern':>10} {'peak RSS':>12}")
+        for pattern in PATTERNS:
+            output = subprocess.run([sys.executable, "-m", __spec__.name, "--pattern", pattern, "--path", path],
+                                    check=True, capture_output=True, text=True).stdout
+            print(f"{pattern:>10} {float(output):>8.1f} MiB")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--pattern", choices=PATTERNS, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.pattern:
+        asyncio.run(run(args.pattern, args.path))
+        print(peak_rss_mib())
+    else:
+        main(args.size_mb)
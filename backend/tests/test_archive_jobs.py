@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from backend.app import archive_jobs
+from backend.app.cache import LRUCache
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    monkeypatch.setattr(archive_jobs, "queued", [])
+    monkeypatch.setattr(archive_jobs, "running", set())
+    monkeypatch.setattr(archive_jobs, "active_jobs", {})
+    monkeypatch.setattr(archive_jobs, "jobs_by_study", {})
+    monkeypatch.setattr(archive_jobs, "_submissions", set())
+    monkeypatch.setattr(archive_jobs, "early_events", LRUCache(10))
+    monkeypatch.setattr(archive_jobs, "ARCHIVE_JOB_SLOTS", 2)
+    monkeypatch.setattr(archive_jobs, "ARCHIVE_USER_SLOTS", 1)
+
+    async def create_job(study_id: str) -> str:
+        return f"job-{study_id}"
+
+    monkeypatch.setattr(archive_jobs, "create_job", create_job)
+
+
+def run(scenario):
+    async def main():
+        try:
+            return await scenario()
+        finally:
+            await asyncio.gather(*archive_jobs._submissions)
+
+    return asyncio.run(main())
+
+
+def running_studies() -> list[str]:
+    return sorted(job.study_id for job in archive_jobs.running)
+
+
+def queued_studies() -> list[str]:
+    return [job.study_id for job in archive_jobs.queued]
+
+
+def test_user_cap_yields_to_other_users():
+    async def scenario():
+        for study_id in ("a1", "a2", "a3"):
+            archive_jobs.start(study_id, "alice")
+        # Nobody else waits, so alice may use both slots
+        assert running_studies() == ["a1", "a2"]
+        archive_jobs.start("b1", "bob")
+        archive_jobs.finish(archive_jobs.jobs_by_study["a1"], {"Progress": 100, "State": "Success"})
+        # bob is under his share and goes before alice's third study
+        assert running_studies() == ["a2", "b1"]
+        assert queued_studies() == ["a3"]
+
+    run(scenario)
+
+
+def test_queue_follows_priority_then_arrival():
+    async def scenario():
+        archive_jobs.start("s1", "alice")
+        archive_jobs.start("s2", "bob")
+        bulk = archive_jobs.start("s3", "carol", "bulk")
+        normal = archive_jobs.start("s4", "dave")
+        urgent = archive_jobs.start("s5", "erin", "urgent")
+        assert queued_studies() == ["s5", "s4", "s3"]
+        assert [urgent.status, normal.status, bulk.status] == [
+            {"State": "Queued", "Position": 1}, {"State": "Queued", "Position": 2}, {"State": "Queued", "Position": 3}]
+        # An urgent request for a study already queued as bulk moves it forward, it keeps its arrival order
+        assert archive_jobs.start("s3", "frank", "urgent") is bulk
+        assert queued_studies() == ["s3", "s5", "s4"]
+
+    run(scenario)
+
+
+def test_unsubscribing_the_last_viewer_drops_a_queued_job():
+    async def scenario():
+        archive_jobs.start("s1", "alice")
+        archive_jobs.start("s2", "bob")
+        first = archive_jobs.start("s3", "carol")
+        second = archive_jobs.start("s4", "dave")
+        updates = archive_jobs.subscribe(first)
+        other = archive_jobs.subscribe(first)
+        archive_jobs.unsubscribe(first, updates)
+        assert queued_studies() == ["s3", "s4"]
+        archive_jobs.unsubscribe(first, other)
+        assert queued_studies() == ["s4"]
+        assert "s3" not in archive_jobs.jobs_by_study
+        assert second.status == {"State": "Queued", "Position": 1}
+
+    run(scenario)
+
+
+def test_running_jobs_stay_without_viewers():
+    async def scenario():
+        job = archive_jobs.start("s1", "alice")
+        archive_jobs.unsubscribe(job, archive_jobs.subscribe(job))
+        await asyncio.gather(*archive_jobs._submissions)
+        assert archive_jobs.active_jobs == {"job-s1": job}
+
+    run(scenario)
+
+
+def test_full_queue_rejects(monkeypatch):
+    monkeypatch.setattr(archive_jobs, "ARCHIVE_USER_QUEUE_LIMIT", 1)
+
+    async def scenario():
+        for study_id in ("a1", "a2", "a3"):
+            archive_jobs.start(study_id, "alice")
+        with pytest.raises(archive_jobs.ArchiveQueueFull):
+            archive_jobs.start("a4", "alice")
+
+    run(scenario)
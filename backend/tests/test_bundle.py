@@ -0,0 +1,107 @@
+import asyncio
+import io
+import zipfile
+
+import httpx
+import pytest
+
+from backend.app import bundle, orthanc_client
+
+STUDY = {"ID": "study-1", "MainDicomTags": {"StudyDate": "20240101", "StudyDescription": "CT HEAD"},
+         "PatientMainDicomTags": {"PatientName": "DOE^JOHN", "PatientID": "P1"}}
+SERIES = [{"ID": "series-1", "MainDicomTags": {"SeriesNumber": "2", "Modality": "CT"},
+           "Instances": ["instance-1", "instance-2"]}]
+
+
+class Blocked(httpx.AsyncByteStream):
+    # An instance download that never finishes, until cancelled
+    def __init__(self, opened: list):
+        self.opened = opened
+
+    async def __aiter__(self):
+        self.opened.append(self)
+        await asyncio.Event().wait()
+        yield b""
+
+
+def orthanc(blocked_instances=(), opened=None):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path == "/studies/study-1":
+            return httpx.Response(200, json=STUDY)
+        if path == "/studies/study-1/series":
+            return httpx.Response(200, json=SERIES)
+        if path.startswith("/instances/") and path.endswith("/file"):
+            instance_id = path.split("/")[2]
+            if instance_id in blocked_instances:
+                return httpx.Response(200, stream=Blocked(opened))
+            return httpx.Response(200, content=f"DICM {instance_id}".encode() * 1000)
+        return httpx.Response(404, json={})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://orthanc")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def install(*args, **kwargs):
+        monkeypatch.setattr(orthanc_client, "_client", orthanc(*args, **kwargs))
+
+    return install
+
+
+async def collect(chunks) -> zipfile.ZipFile:
+    return zipfile.ZipFile(io.BytesIO(b"".join([chunk async for chunk in chunks])))
+
+
+@pytest.mark.parametrize("layout, folder", [
+    ("patient", "DOE_JOHN_P1/20240101_CT_HEAD_study-1/2_CT_series-1"),
+    ("study", "20240101_CT_HEAD_study-1/2_CT_series-1"),
+    ("series", "2_CT_series-1"),
+])
+def test_bundle_holds_every_instance_in_the_layout(client, layout, folder):
+    client()
+    archive = asyncio.run(collect(bundle.stream_bundle(["study-1"], layout, window=1, prefetch_bytes=1024)))
+    assert archive.namelist() == [f"{folder}/instance-1.dcm", f"{folder}/instance-2.dcm"]
+    assert archive.read(f"{folder}/instance-2.dcm") == b"DICM instance-2" * 1000
+    assert archive.testzip() is None
+
+
+def test_failures_are_listed_inside_the_archive(client):
+    client()
+    archive = asyncio.run(collect(bundle.stream_bundle(["study-1", "missing"], "series")))
+    assert "ERRORS.txt" in archive.namelist()
+    assert archive.read("ERRORS.txt").startswith(b"study missing: ")
+    assert len(archive.namelist()) == 3
+
+
+def test_closing_the_stream_cancels_downloads(client):
+    opened = []
+    client(blocked_instances={"instance-2"}, opened=opened)
+
+    async def main():
+        chunks = bundle.stream_bundle(["study-1"], "series", window=4)
+        await chunks.__anext__()
+        while not opened:
+            await asyncio.sleep(0)
+        await chunks.aclose()
+        await asyncio.sleep(0)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(main()) == []
+
+
+def test_budget_holds_back_instances_ahead_of_the_head():
+    async def main():
+        budget = bundle.ByteBudget(10)
+        await budget.acquire(1, 8)
+        ahead = asyncio.create_task(budget.acquire(2, 8))
+        await asyncio.sleep(0)
+        waited = not ahead.done()
+        # The head is never held back, or the archive could stall behind instances further ahead
+        await asyncio.wait_for(budget.acquire(0, 8), 1)
+        await budget.release(8)
+        await budget.release(8)
+        await asyncio.wait_for(ahead, 1)
+        return waited, budget.used
+
+    assert asyncio.run(main()) == (True, 8)
@@ -0,0 +1,93 @@
+import asyncio
+
+import httpx
+import pytest
+
+from backend.app import circuit_breaker, orthanc_client
+from backend.app.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.stats()["rejected_calls"] == 1
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.stats()["state"] == "closed"
+    breaker.before_call()
+
+
+def test_failed_trial_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert breaker.stats()["times_opened"] == 2
+    clock[0] += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_abandoned_trial_frees_the_slot(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.abandon_call()
+    breaker.before_call()
+    assert breaker.stats()["state"] == "half_open"
+
+
+def test_request_retries_then_fails_fast(monkeypatch):
+    # Three attempts of one request open a breaker with a threshold of three, the next request fails fast
+    monkeypatch.setattr(orthanc_client, "ORTHANC_RETRIES", 2)
+    monkeypatch.setattr(orthanc_client, "breaker", CircuitBreaker(failure_threshold=3, reset_timeout=30))
+    monkeypatch.setattr(orthanc_client, "ORTHANC_RETRY_BACKOFF", 0)
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        return httpx.Response(503)
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://orthanc") as client:
+            response = await orthanc_client.request(client, "GET", "/studies")
+            with pytest.raises(orthanc_client.OrthancUnavailable):
+                await orthanc_client.request(client, "GET", "/studies")
+            return response
+
+    response = asyncio.run(main())
+    assert response.status_code == 503
+    assert len(calls) == 3
+    assert orthanc_client.breaker.is_open
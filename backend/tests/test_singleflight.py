@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import pytest
+
+from backend.app import orthanc_client
+from backend.app.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"ID": "study"}
+
+        waiters = [asyncio.create_task(flights.do("/studies/study", fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return calls, results, flights.stats()
+
+    calls, results, stats = asyncio.run(main())
+    assert calls == 1
+    assert results == [{"ID": "study"}] * 5
+    assert stats == {"in_flight": 0, "calls": 1, "shared": 4}
+
+
+def test_distinct_keys_run_separately():
+    async def main():
+        flights = SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return value
+
+        return await asyncio.gather(flights.do("a", lambda: fetch(1)), flights.do("b", lambda: fetch(2)))
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(flights.do("key", fetch))
+        second = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return first, await second
+
+    first, result = asyncio.run(main())
+    assert first.cancelled()
+    assert result == "done"
+
+
+def test_failure_reaches_every_caller_and_frees_the_key():
+    async def main():
+        flights = SingleFlight()
+        attempts = 0
+
+        async def fetch():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0)
+            if attempts == 1:
+                raise ValueError("boom")
+            return "ok"
+
+        results = await asyncio.gather(flights.do("key", fetch), flights.do("key", fetch), return_exceptions=True)
+        return results, await flights.do("key", fetch)
+
+    results, retried = asyncio.run(main())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert retried == "ok"
+
+
+@pytest.mark.parametrize("generations, expected_requests", [((0, 0), 1), ((0, 1), 2)])
+def test_get_json_shares_flights_only_within_a_cache_version(generations, expected_requests):
+    requests = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"ID": "study"})
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://orthanc") as client:
+            return await asyncio.gather(*(orthanc_client.get_json(client, "/studies/study", generation)
+                                          for generation in generations))
+
+    assert asyncio.run(main()) == [{"ID": "study"}] * 2
+    assert len(requests) == expected_requests
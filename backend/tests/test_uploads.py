@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.app import ingest, uploads
+
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(uploads, "_locks", {})
+    return tmp_path
+
+
+async def body(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+def summary(failed: int) -> dict:
+    return {"total": 1, "stored": 1 - failed, "duplicate": 0, "failed": failed,
+            "duplicates_skipped": 0, "bytes_saved": 0, "instances": []}
+
+
+def test_chunks_append_at_the_current_offset():
+    async def main():
+        session = await uploads.create_session("a.dcm", 6)
+        await uploads.append_chunk(session["upload_id"], 0, body(b"abc"))
+        with pytest.raises(HTTPException) as mismatch:
+            await uploads.append_chunk(session["upload_id"], 0, body(b"abc"))
+        with pytest.raises(HTTPException) as too_long:
+            await uploads.append_chunk(session["upload_id"], 3, body(b"de", b"fgh"))
+        return mismatch.value, too_long.value, await uploads.get_session(session["upload_id"])
+
+    mismatch, too_long, session = asyncio.run(main())
+    assert mismatch.status_code == 409
+    assert too_long.status_code == 413
+    # The rejected chunk is cut off again, the client resumes from the last good offset
+    assert session["offset"] == 3
+
+
+def test_finalize_rejects_incomplete_uploads():
+    async def main():
+        session = await uploads.create_session("a.dcm", 6)
+        await uploads.append_chunk(session["upload_id"], 0, body(b"abc"))
+        with pytest.raises(HTTPException) as incomplete:
+            await uploads.finalize(session["upload_id"])
+        return incomplete.value
+
+    assert asyncio.run(main()).status_code == 409
+
+
+def test_finalize_keeps_the_session_until_every_instance_is_stored(monkeypatch, upload_dir):
+    results = [summary(failed=1), summary(failed=0)]
+    received = []
+
+    async def fake_ingest(sources):
+        received.extend(name for name, _, _ in sources)
+        return results.pop(0)
+
+    monkeypatch.setattr(ingest, "ingest", fake_ingest)
+
+    async def main():
+        session = await uploads.create_session("a.dcm", 3)
+        await uploads.append_chunk(session["upload_id"], 0, body(b"abc"))
+        first = await uploads.finalize(session["upload_id"])
+        kept = await uploads.get_session(session["upload_id"])
+        second = await uploads.finalize(session["upload_id"])
+        with pytest.raises(HTTPException) as gone:
+            await uploads.get_session(session["upload_id"])
+        return first, kept, second, gone.value
+
+    first, kept, second, gone = asyncio.run(main())
+    assert first["failed"] == 1 and kept["offset"] == 3
+    assert second["failed"] == 0 and gone.status_code == 404
+    assert received == ["a.dcm", "a.dcm"]
+    assert list(upload_dir.iterdir()) == []
+    assert uploads._locks == {}
+
+
+def test_unknown_sessions_get_no_lock():
+    async def main():
+        with pytest.raises(HTTPException) as unknown:
+            await uploads.finalize("0" * 32)
+        return unknown.value
+
+    assert asyncio.run(main()).status_code == 404
+    assert uploads._locks == {}
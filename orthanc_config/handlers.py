@@ -1,16 +1,92 @@
+import json
+import os
+import queue
+import threading
+
 import orthanc
+import requests
+
+# Backend endpoint that forwards job progress to /ws/archive-status subscribers
+JOB_EVENTS_URL = os.getenv("JOB_EVENTS_URL", "http://backend:8000/internal/jobs/events")
+JOB_EVENTS_TOKEN = os.getenv("JOB_EVENTS_TOKEN", "")
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "0.5"))
+# After a failed push, events are dropped for a while; the backend falls back to polling meanwhile
+JOB_EVENTS_RETRY_DELAY = float(os.getenv("JOB_EVENTS_RETRY_DELAY", "5"))
+
+ACTIVE_JOB_STATES = ("Pending", "Running", "Paused", "Retry")
+
+job_events = queue.Queue(maxsize=1000)
+stopped = threading.Event()
+
+
+def push_job_event(job_id, state, progress):
+    try:
+        job_events.put_nowait({"ID": job_id, "State": state, "Progress": progress})
+    except queue.Full:
+        pass
+
+
+def send_job_events():
+    # Runs in its own thread, so a slow backend never blocks Orthanc callbacks
+    session = requests.Session()
+    headers = {"X-Job-Events-Token": JOB_EVENTS_TOKEN}
+    while not stopped.is_set():
+        try:
+            events = [job_events.get(timeout=1)]
+        except queue.Empty:
+            continue
+        while not job_events.empty():
+            events.append(job_events.get_nowait())
+        try:
+            session.post(JOB_EVENTS_URL, json={"jobs": events}, headers=headers, timeout=2).raise_for_status()
+        except requests.RequestException as e:
+            print('Could not push job events to %s: %s' % (JOB_EVENTS_URL, e))
+            stopped.wait(JOB_EVENTS_RETRY_DELAY)
+
+
+def watch_job_progress():
+    # Orthanc raises change events only when a job ends, progress is read in-process from /jobs
+    sent = {}
+    while not stopped.wait(JOB_PROGRESS_INTERVAL):
+        try:
+            jobs = json.loads(orthanc.RestApiGet('/jobs?expand'))
+        except Exception as e:
+            print('Could not read jobs: %s' % e)
+            continue
+        active = {}
+        for job in jobs:
+            if job.get('State') in ACTIVE_JOB_STATES:
+                status = (job['State'], job.get('Progress', 0))
+                active[job['ID']] = status
+                if sent.get(job['ID']) != status:
+                    push_job_event(job['ID'], *status)
+        sent = active
+
 
 def OnChange(changeType, level, resource):
     if changeType == orthanc.ChangeType.ORTHANC_STARTED:
         print('Started')
 
+        if JOB_EVENTS_TOKEN:
+            threading.Thread(target=send_job_events, daemon=True).start()
+            threading.Thread(target=watch_job_progress, daemon=True).start()
+        else:
+            print('JOB_EVENTS_TOKEN is not set, job events are not pushed to the backend')
+
         with open('/tmp/sample.dcm', 'rb') as f:
             orthanc.RestApiPost('/instances', f.read())
 
     elif changeType == orthanc.ChangeType.ORTHANC_STOPPED:
         print('Stopped')
+        stopped.set()
 
     elif changeType == orthanc.ChangeType.NEW_INSTANCE:
         print('A new instance was uploaded: %s' % resource)
 
-orthanc.RegisterOnChangeCallback(OnChange)
\ No newline at end of file
+    elif changeType == orthanc.ChangeType.JOB_SUCCESS:
+        push_job_event(resource, 'Success', 100)
+
+    elif changeType == orthanc.ChangeType.JOB_FAILURE:
+        push_job_event(resource, 'Failure', 0)
+
+orthanc.RegisterOnChangeCallback(OnChange)